@@ -1,3 +1,3 @@
 from .volume_adjust import measure
 from .version import version, version_tuple
-from .volume_adjust_eval import evaluate
\ No newline at end of file
+from .volume_adjust_eval import evaluate, evaluate_live
\ No newline at end of file
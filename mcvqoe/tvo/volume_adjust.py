@@ -1,9 +1,13 @@
+import asyncio
+import concurrent.futures
 import csv
 import datetime
+import math
 import mcvqoe.base
-import mcvqoe.math
+import mcvqoe.delay
 import os
 import pkg_resources
+import scipy.fft
 import scipy.signal
 import time
 
@@ -11,9 +15,428 @@ import numpy as np
 
 from collections import namedtuple
 from fractions import Fraction
+from functools import partial
+from mcvqoe.base.fsf import calc_slope
 from mcvqoe.base.terminal_user import terminal_progress_update
 from warnings import warn
 
+from .volume_adjust_archive import recording_archive
+from .volume_adjust_metrics import metrics_server, session_metrics
+from .volume_adjust_profiler import session_profiler
+from .volume_adjust_profiles import device_profiles
+from .volume_adjust_trials import trial_store
+
+try:
+    import soundfile
+except ImportError:
+    # Only needed to compress recordings
+    soundfile = None
+
+def compress_recording(wav_name):
+    """
+    Losslessly compress a wav recording to FLAC and remove the wav file.
+    
+    Only integer PCM can be stored losslessly in FLAC. Recordings in other
+    formats are left as wav files.
+    
+    Parameters
+    ----------
+    wav_name : str
+        Path to the wav file.
+        
+    Returns
+    -------
+    str
+        Path to the compressed file, or wav_name if it was not compressed.
+    """
+    info = soundfile.info(wav_name)
+    if info.subtype not in ('PCM_S8', 'PCM_U8', 'PCM_16', 'PCM_24'):
+        return wav_name
+    
+    data, fs = soundfile.read(wav_name, dtype='int32')
+    flac_name = os.path.splitext(wav_name)[0] + '.flac'
+    soundfile.write(flac_name, data, fs, subtype=info.subtype, format='FLAC')
+    os.remove(wav_name)
+    
+    return flac_name
+
+# Pause, in seconds, yielded by measurement step generators. Anything else
+# yielded is a blocking function that is called with no arguments.
+_wait = namedtuple('_wait', ['seconds'])
+
+def _step_name(step):
+    """Return the function name of a step, 'wait' for pauses."""
+    if isinstance(step, _wait):
+        return 'wait'
+    return getattr(getattr(step, 'func', step), '__name__', '')
+
+def _drive(steps, profiler=None):
+    """
+    Run a measurement step generator, blocking on each step.
+    
+    Exceptions raised by a step are raised in the generator at the step so
+    that it can clean up.
+    
+    Parameters
+    ----------
+    steps : generator
+        Generator that yields _wait pauses and blocking functions.
+    profiler : session_profiler, optional
+        Profiler that the time of each step is added to.
+        
+    Returns
+    -------
+    Return value of the generator.
+    """
+    result = None
+    exc = None
+    while True:
+        try:
+            step = steps.throw(exc) if exc is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        result = exc = None
+        t_step = time.perf_counter()
+        try:
+            if isinstance(step, _wait):
+                time.sleep(step.seconds)
+            else:
+                result = step()
+        except BaseException as e:
+            exc = e
+        if profiler is not None:
+            profiler.add(_step_name(step), time.perf_counter() - t_step)
+
+async def _drive_async(steps, executor=None, profiler=None):
+    """
+    Run a measurement step generator on the running event loop.
+    
+    Pauses are awaited with asyncio.sleep and blocking functions are run in
+    executor. Cancellation is raised in the generator at the current step.
+    A blocking function can't be stopped once it has started, so when the
+    task is cancelled during one, it is allowed to finish before the
+    cancellation is raised in the generator. This keeps cleanup, such as
+    releasing the PTT, from running while play_record is still using the
+    audio device.
+    
+    Parameters
+    ----------
+    steps : generator
+        Generator that yields _wait pauses and blocking functions.
+    executor : concurrent.futures.Executor, optional
+        Executor for blocking functions. Defaults to the event loop default
+        executor.
+    profiler : session_profiler, optional
+        Profiler that the time of each step is added to.
+        
+    Returns
+    -------
+    Return value of the generator.
+    """
+    loop = asyncio.get_running_loop()
+    result = None
+    exc = None
+    while True:
+        try:
+            step = steps.throw(exc) if exc is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        result = exc = None
+        t_step = time.perf_counter()
+        try:
+            if isinstance(step, _wait):
+                await asyncio.sleep(step.seconds)
+            else:
+                future = loop.run_in_executor(executor, step)
+                try:
+                    result = await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    # Wait for the step to finish before cleaning up. A second
+                    # cancel stops waiting.
+                    try:
+                        await future
+                    except BaseException:
+                        pass
+                    raise
+        except BaseException as e:
+            exc = e
+        if profiler is not None:
+            profiler.add(_step_name(step), time.perf_counter() - t_step)
+
+def frame_levels(x, frame):
+    """
+    Level, in dB, of non overlapping frames of audio.
+    
+    Parameters
+    ----------
+    x : numpy array
+        Float audio.
+    frame : int
+        Frame length in samples.
+        
+    Returns
+    -------
+    numpy array
+        RMS level of each complete frame in dB.
+    """
+    n = (len(x) // frame) * frame
+    rms = np.sqrt(np.mean(np.square(x[:n].reshape(-1, frame)), axis=1))
+    return 20*np.log10(np.maximum(rms, 1e-10))
+
+def approx_permutation_test(x, y, rng, R=10000, alpha=0.05):
+    """
+    Two sided approximate permutation test for a difference in means.
+    
+    All R permutations are drawn at once from rng so results are
+    reproducible for a given generator state. The p-value and rejection rule
+    are the same as mcvqoe.math.approx_permutation_test.
+    
+    Parameters
+    ----------
+    x : numpy array
+        First sample.
+    y : numpy array
+        Second sample.
+    rng : numpy.random.Generator
+        Random number generator used to draw permutations.
+    R : int, optional
+        Number of permutations. Defaults to 10000.
+    alpha : float, optional
+        Significance level. Defaults to 0.05.
+        
+    Returns
+    -------
+    bool
+        True if the null hypothesis of equal means is rejected.
+    """
+    x = np.asarray(x, dtype=float).flatten()
+    y = np.asarray(y, dtype=float).flatten()
+    
+    xy = np.concatenate((x, y))
+    # Observed difference in means
+    obs = np.abs(np.mean(x) - np.mean(y))
+    # Permute all samples at once, one permutation per row
+    perms = rng.permuted(np.tile(xy, (R, 1)), axis=1)
+    diffs = np.abs(np.mean(perms[:, :len(x)], axis=1) - np.mean(perms[:, len(x):], axis=1))
+    # Fraction of permutations at least as extreme as observed
+    p = np.count_nonzero(diffs >= obs) / R
+    
+    return p <= alpha
+
+class clip_reference:
+    """
+    Reference side features of a transmit clip.
+    
+    Features of the transmit clip are computed once and reused for every
+    trial that uses the clip. The frequency slope of the clip is cached for
+    FSF scoring. The amplitude envelope of the clip is used to find the
+    approximate delay of a recording so that the recording can be trimmed
+    before scoring, and the exact alignment only has to be searched in a
+    short span.
+    
+    Delays are returned in the convention of mcvqoe.base.fsf, negative for
+    a recording that lags the clip.
+    
+    Parameters
+    ----------
+    audio : numpy array
+        Transmit clip.
+    fs : int
+        Sample rate of audio.
+    env_rate : float, optional
+        Sample rate of the envelope in Hz. Defaults to 1 kHz.
+        
+    Attributes
+    ----------
+    audio : numpy array
+        Transmit clip.
+    fs : int
+        Sample rate of audio.
+    slope : float
+        Frequency slope of the clip, see mcvqoe.base.fsf.
+    env : numpy array
+        Mean removed amplitude envelope of the clip.
+    """
+    
+    def __init__(self, audio, fs, env_rate=1000):
+        self.audio = audio
+        self.fs = fs
+        # Envelope decimation factor
+        self.env_factor = max(1, int(fs // env_rate))
+        
+        self.slope = calc_slope(audio)
+        
+        audio_fl = mcvqoe.base.audio_float(audio)
+        self.env = self.envelope(audio_fl)
+        self.env_norm = np.linalg.norm(self.env)
+        # Envelope spectra, by FFT length
+        self._spec = {}
+        
+    def envelope(self, x):
+        """
+        Compute the mean removed amplitude envelope of x.
+        
+        Parameters
+        ----------
+        x : numpy array
+            Float audio. Only the first channel is used for 2D arrays.
+            
+        Returns
+        -------
+        numpy array
+            Envelope at env_rate.
+        """
+        if x.ndim > 1:
+            x = x[:, 0]
+        n = (len(x) // self.env_factor) * self.env_factor
+        env = np.abs(x[:n]).reshape(-1, self.env_factor).mean(axis=1)
+        return env - np.mean(env)
+    
+    def fsf(self, rec_dat):
+        """
+        Compute the FSF score and delay of a recording.
+        
+        This is mcvqoe.base.fsf with the cached clip slope.
+        
+        Parameters
+        ----------
+        rec_dat : numpy array
+            Received audio.
+            
+        Returns
+        -------
+        fsf_score : float
+            FSF score of the recording.
+        dly : int
+            Delay of the recording in samples, in the fsf convention.
+        """
+        # Argument order and sample rate as in mcvqoe.base.fsf
+        _, dly = mcvqoe.delay.ITS_delay_est(rec_dat, self.audio, mode='f', fs=48000)
+        start = max(dly, 0)
+        rx_slope = calc_slope(rec_dat[start:start + len(self.audio)])
+        
+        return np.true_divide(rx_slope, self.slope), dly
+    
+    def spectrum(self, nfft):
+        """Return the conjugate spectrum of the clip envelope, cached by nfft."""
+        if nfft not in self._spec:
+            self._spec[nfft] = np.conj(scipy.fft.rfft(self.env, nfft))
+        return self._spec[nfft]
+    
+    def delay(self, rec_dat, lags=None):
+        """
+        Estimate the delay of the clip in a recording from envelopes.
+        
+        Parameters
+        ----------
+        rec_dat : numpy array
+            Float audio of the recording.
+        lags : tuple of ints, optional
+            First and last lag, in samples, to consider. Only the part of
+            the recording that can contain the clip at these delays is
+            searched. Defaults to all delays where the clip fits in the
+            recording.
+            
+        Returns
+        -------
+        dly : int or None
+            Lag of the clip in the recording in samples, positive when the
+            recording lags the clip. None if the recording is too short.
+        conf : float
+            Normalized envelope correlation at dly. Values near 1 indicate a
+            reliable estimate.
+        """
+        if lags is not None:
+            # Only compute the envelope where the clip can be
+            lo = max(0, lags[0] // self.env_factor)
+            hi = lags[1] // self.env_factor + 1
+            rec_dat = rec_dat[lo*self.env_factor:(hi + len(self.env))*self.env_factor]
+        else:
+            lo = 0
+            
+        env_rx = self.envelope(rec_dat)
+        n_lags = len(env_rx) - len(self.env) + 1
+        if n_lags < 1 or self.env_norm == 0:
+            return None, 0.0
+        
+        # Cross correlation of envelopes, only non-negative lags are valid
+        nfft = scipy.fft.next_fast_len(len(env_rx) + len(self.env) - 1)
+        corr = scipy.fft.irfft(scipy.fft.rfft(env_rx, nfft) * self.spectrum(nfft), nfft)[:n_lags]
+        
+        # Energy of the recording envelope under the clip at each lag
+        energy = np.cumsum(np.concatenate(([0], np.square(env_rx))))
+        energy = energy[len(self.env):] - energy[:n_lags]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ncorr = corr / (self.env_norm * np.sqrt(energy))
+        ncorr = np.nan_to_num(ncorr)
+        
+        peak = np.argmax(ncorr)
+        
+        return (peak + lo) * self.env_factor, float(ncorr[peak])
+    
+    def score(self, rec_dat, margin=0.1, threshold=0.5):
+        """
+        Compute the FSF score and delay of a recording.
+        
+        The recording is trimmed to the clip length plus margin on each side
+        of the estimated delay. If the delay estimate is not reliable the
+        full recording is used.
+        
+        Parameters
+        ----------
+        rec_dat : numpy array
+            Float audio of the recording.
+        margin : float, optional
+            Time, in seconds, to keep on each side of the clip. Defaults to
+            0.1 s.
+        threshold : float, optional
+            Minimum envelope correlation to trust the delay estimate.
+            Defaults to 0.5.
+            
+        Returns
+        -------
+        fsf_score : float
+            FSF score of the recording.
+        dly : int
+            Delay of the recording in samples, in the fsf convention.
+        """
+        dly, conf = self.delay(rec_dat)
+        
+        if dly is None or conf < threshold:
+            # Not confident, let fsf search the whole recording
+            return self.fsf(rec_dat)
+        
+        return self.score_at(rec_dat, dly, margin)
+    
+    def score_at(self, rec_dat, dly, margin):
+        """
+        Compute FSF score for a recording trimmed around a known delay.
+        
+        Parameters
+        ----------
+        rec_dat : numpy array
+            Float audio of the recording.
+        dly : int
+            Approximate lag of the clip in samples, see delay.
+        margin : float
+            Time, in seconds, to keep on each side of the clip.
+            
+        Returns
+        -------
+        fsf_score : float
+            FSF score of the recording.
+        dly : int
+            Delay of the recording in samples, in the fsf convention.
+        """
+        margin = int(margin * self.fs)
+        start = max(0, dly - margin)
+        end = dly + len(self.audio) + margin
+        
+        fsf_score, seg_dly = self.fsf(rec_dat[start:end])
+        
+        # fsf delays are negative for a lagging recording
+        return fsf_score, seg_dly - start
+
 class measure:
     """
     Class to determine optimal volume for a test setup. A Transmit Volume
@@ -23,43 +446,176 @@ class measure:
     ----------
     audio_files : list of strings
         List of names of audio files. Paths are relative to audio_path if given.
+    align : boolean
+        Trim each recording around the delay found from the clip envelope
+        before FSF scoring. This is faster for long recordings but FSF and
+        M2E values can differ from scoring the full recording. Default is
+        False.
+    align_margin : float
+        Time, in seconds, of recording kept on each side of the clip when
+        a recording is trimmed before FSF scoring. Defaults to 0.1 s.
+    align_threshold : float
+        Minimum envelope correlation for a delay estimate to be used to trim
+        a recording. Recordings below this are scored without trimming. Only
+        used when align is True or m2e_window is given. Defaults to 0.5.
+    archive : boolean
+        Store recordings in a single archive file, with an index, in the wav
+        folder instead of a wav file for each trial. See recording_archive.
+        Only used when save_audio is True. Default is False.
     audio_path : string
         Path where audio is stored.
+    check_min_trials : int
+        Number of earlier trials needed before a trial is checked against
+        the M2E latency median or for FSF outliers. Default is 5.
+    clip_level : float
+        Magnitude, of float audio, at or above which a received sample is
+        counted as clipped. Default is 0.99.
+    clip_prune : boolean
+        Lower the upper limit of the search to a volume as soon as the
+        median clip ratio of its trials is above clip_threshold. Volumes at
+        or above it are not measured again, the clipped trials are used for
+        them. Not used when per_clip is True or volumes are given. Default
+        is False.
+    clip_threshold : float
+        Fraction of clipped samples above which a volume is clipped when
+        clip_prune is True. Default is 0.001.
+    compress_audio : boolean
+        Compress saved recordings to FLAC in a background thread while the
+        test continues. An 'Audio' column with the compressed file name is
+        added to the csv. Recordings that fail to compress are reported
+        when the session ends. Requires the soundfile package. Not used when
+        archive is True. Default is False.
+    cal_len : float
+        Length, in seconds, of each level in the precharacterization sweep.
+        Default is 0.5 s.
+    cal_snr : float
+        Minimum received signal to noise ratio, in dB, for a level to be
+        usable in the precharacterization sweep. Default is 10 dB.
+    cal_steps : int
+        Number of levels in the precharacterization sweep. Default is 9.
+    m2e_window : float or None
+        If given, the delay search for each trial is limited to m2e_window
+        seconds on either side of the median mouth-to-ear latency of the
+        previous trials in the session. Trials where the narrowed search is
+        not reliable, or where fsf puts the delay at the edge of the trimmed
+        recording, are scored with a full search. Default is None, always
+        search the full recording.
+    burst_guard : float
+        Silence, in seconds, placed after each clip in a burst. Must be longer
+        than the mouth-to-ear latency of the device. Defaults to 1 s.
+    burst_size : int
+        Number of clips to play in each transmission. Clips are separated by
+        burst_guard seconds of silence and the recording is split back into
+        one recording per clip. Reduces the ptt_wait and ptt_gap overhead per
+        trial. Defaults to 1.
     audio_interface : mcvqoe.AudioPlayer or mcvqoe.simulation.QoEsim
         Interface to use to play and record audio on the communication channel
+    coarse_rep : int or None
+        Number of trials for each volume of the initial grid. After the
+        initial grid the volumes inside the chosen interval are topped up
+        to ptt_rep trials and all later volumes use ptt_rep trials. Not used
+        when per_clip is True. Default is None, all volumes use ptt_rep
+        trials.
     dev_volume : float
         Volume setting on the device. This tells VolumeAdjust what the output
         volume of the audio device is. This is taken into account when the
         scaling is done for the trials. Default is 0 dB.
+    fsf_outlier : float
+        A trial is bad if its FSF score is more than this many scaled
+        median absolute deviations from the median of the earlier trials
+        at the same volume. Default is 5.
     get_post_notes : function or None
         Function called to get notes at the end of the test. Often set to
         mcvqoe-post_test to get notes with a gui popup.
         lambda : mcvqoe.post_test(error_only=True) can be used if notes should
         only be gathered when there is an error
+    grid_points : int
+        Number of volumes in the initial grid. Default is 10.
     info : dict
         Dictionary with test info for the log entry
     lim : list of floats
         TLim must be a 2 element list that is increasing. lim sets the volume
         limits to use for the test in dB. lim defaults to [-40.0, 0.0].
+    m2e_tol : float
+        A trial is bad if its M2E latency is more than this many seconds
+        from the median latency of the session. Default is 0.1 s.
+    max_retries : int
+        Number of times a bad trial is run again. Bad trials are found from
+        a low received level (see min_rx_snr), an unusual M2E latency (see
+        m2e_tol) or an outlying FSF score (see fsf_outlier) and are logged
+        to a '_BAD.csv' file next to the data file. If a trial is still bad
+        after max_retries retries it is kept. Default is 0, bad trials are
+        logged but not retried.
+    metrics_host : string
+        Address the metrics endpoint listens on. Default is '127.0.0.1',
+        local connections only.
+    metrics_port : int or None
+        If given, serve session progress on this port in the Prometheus
+        text format while run is running. Metrics include trials done,
+        trials per minute, the current interval, grid spacing relative to
+        tol, steps remaining with an ETA and error counts. Metrics are
+        labeled with the 'Test Type' in info. Default is None, no metrics
+        are served.
+    min_rx_snr : float
+        A trial is bad if the RMS level of its recording is less than this
+        many dB above the noise floor of the recording. The check is relative
+        so that quiet trials at low volumes are not flagged. Default is
+        10 dB.
     no_log : tuple of strings
         Static property that is a tuple of property names that will not be added
         to the 'Arguments' field in the log. This should not be modified in most
         cases.
     outdir : string, default=''
         Base directory where data is stored
+    profile_margin : float
+        Margin, in dB, added on each side of the interval from the device
+        profile store. Default is 3 dB.
+    profile_path : string or None
+        Path to the device profile store. If None the default location is
+        used, see device_profiles. Default is None.
+    profiling : boolean
+        Profile each session. Time spent loading audio, scoring, in the
+        optimizer, in file I/O and in play/record is recorded and the
+        session is run under cProfile. A summary is written to a
+        '_profile.txt' file and cProfile output to a '_profile.prof' file
+        next to the data file. Default is False.
+    per_clip : boolean
+        Find the optimal volume for each audio file in one session using an
+        independent optimizer for each file. Results for each file are
+        written to a '_clips.csv' file next to the data file. Default is
+        False.
+    precharacterize : boolean
+        Run a short sweep before optimizing to find the range of volumes
+        between the noise floor and the onset of clipping and start the
+        optimizer on that range. Only used when scaling is True. Default is
+        False.
     ptt_gap : float
         Time to pause, in seconds, between one trial and the next. Defaults to
         3.1 s.
+    rng : numpy.random.Generator or None
+        Random number generator used for dither and permutation tests in the
+        optimizer. Created from seed when run is called.
     scaling : boolean
         Scale the clip volume to simulate adjusting the device volume to the 
         desired level. If this is False then the user will be prompted every time
         the volume needs to be changed. Defaults to True
+    seed : int or None
+        Seed for rng. If None, a seed is generated when run is called and
+        stored here so that it is written to the log and the optimizer path
+        can be reproduced. Default is None.
     smax : int
         Maximum number of sample volumes to use. Default is 30.
     tol : float
         Tolerance value. Used to set 'Opt.tol'.
-    trials : int
-        Number of trials to run for each sample volume.
+    trials : trial_store
+        Results of every trial in the current session. Created when run is
+        called.
+    use_profile : boolean
+        Use results from previous sessions with the same devices, audio files
+        and sample rate to set the starting interval. lim is only narrowed,
+        never widened. Results of each session are added to the store when
+        this is True. 'Tx Device' and 'Rx Device' must be given in info,
+        otherwise profiles are not used. Default is False.
     volumes : list of floats
         Instead of using the algorithm to determine what volumes to sample,
         explicitly set the volume sample points. When this is given no
@@ -79,6 +635,10 @@ class measure:
         "FSF" : float,
         "m2e_latency" : float,
         "Channels" : mcvqoe.base.parse_audio_channels, 
+        "Rx_Peak" : float,
+        "Clip_Ratio" : float,
+        "Rx_Level_dB" : float,
+        "Noise_Floor_dB" : float,
     }
     
     def __init__(self, **kwargs):
@@ -97,25 +657,57 @@ class measure:
                 "mcvqoe.tvo", "audio_clips/Vol_Set_M4.wav"
                 )
             ]
+        self.align = False
+        self.align_margin = 0.1
+        self.align_threshold = 0.5
+        self.archive = False
         self.audio_path = ""
         self.audio_interface = None
+        self.burst_guard = 1.0
+        self.burst_size = 1
+        self.cal_len = 0.5
+        self.cal_snr = 10.0
+        self.cal_steps = 9
+        self.check_min_trials = 5
+        self.clip_level = 0.99
+        self.clip_prune = False
+        self.clip_threshold = 0.001
+        self.coarse_rep = None
+        self.compress_audio = False
         self.dev_volume = 0.0
+        self.fsf_outlier = 5.0
         self.get_post_notes = None
+        self.grid_points = 10
         self.info = {'Test Type': 'default', 'Pre Test Notes': ''}
         self.iterations = 1
         self.lim = [-40.0, 0.0]
-        self.no_log = ('test', 'ri')
+        self.m2e_tol = 0.1
+        self.m2e_window = None
+        self.max_retries = 0
+        self.metrics_host = '127.0.0.1'
+        self.metrics_port = None
+        self.min_rx_snr = 10.0
+        self.no_log = ('test', 'ri', 'rng', 'recording_archive', 'compress_pool',
+                       'compress_futures', 'trials', 'profiler', 'metrics')
         self.outdir = ""
+        self.per_clip = False
+        self.profile_margin = 3.0
+        self.profiling = False
+        self.profile_path = None
+        self.precharacterize = False
         self.progress_update = terminal_progress_update
         self.ptt_gap = 3.1
         self.ptt_wait = 0.68
         self.ri = None
+        self.rng = None
         self.scaling = True
+        self.seed = None
         self.smax = 30
         # TODO: Add these to be functional
         self.save_audio = True
         self.save_tx_audio = True
         self.tol = 1.0
+        self.use_profile = False
         self.ptt_rep = 40
         self.volumes = []
         # Variables for multiple iterations
@@ -143,6 +735,46 @@ class measure:
             raise ValueError(
                 f"Can't have less than 1 iteration of a test. {self.iterations} iterations chosen."
             )
+        
+        if self.burst_size < 1:
+            raise ValueError(
+                f"burst_size must be at least 1. {self.burst_size} given."
+            )
+        
+        if self.coarse_rep is not None and not (0 < self.coarse_rep <= self.ptt_rep):
+            raise ValueError(
+                f"coarse_rep must be between 1 and ptt_rep. {self.coarse_rep} given."
+            )
+        
+        if self.grid_points < 2:
+            raise ValueError(
+                f"grid_points must be at least 2. {self.grid_points} given."
+            )
+        
+        if self.cal_steps < 3:
+            raise ValueError(
+                f"cal_steps must be at least 3. {self.cal_steps} given."
+            )
+        
+        if self.compress_audio and soundfile is None:
+            raise ValueError(
+                "The soundfile package is required for compress_audio."
+            )
+        
+        if not (0 < self.clip_level <= 1):
+            raise ValueError(
+                f"clip_level must be between 0 and 1. {self.clip_level} given."
+            )
+        
+        if self.max_retries < 0:
+            raise ValueError(
+                f"max_retries must not be negative. {self.max_retries} given."
+            )
+        
+        if self.burst_guard < 0:
+            raise ValueError(
+                f"burst_guard must not be negative. {self.burst_guard} given."
+            )
             
     def csv_header_fmt(self):
         """
@@ -161,11 +793,185 @@ class measure:
         fmt : string
             format string for data lines for the .csv file
         """
-        hdr = ','.join(self.data_fields.keys())+'\n'
-        fmt = '{'+'},{'.join(self.data_fields.keys())+'}\n'
+        fields = list(self.data_fields.keys())
+        if self.compressing():
+            # Compressed recording file
+            fields.append('Audio')
+        
+        hdr = ','.join(fields)+'\n'
+        fmt = '{'+'},{'.join(fields)+'}\n'
         
         return (hdr, fmt)
 
+    def compressing(self):
+        """Return True if recordings are compressed after each trial."""
+        return self.compress_audio and self.save_audio and not self.archive
+    
+    def drain_compress(self):
+        """
+        Wait for background compression to finish and report failures.
+        
+        Returns
+        -------
+        int
+            Number of recordings that could not be compressed.
+        """
+        self.compress_pool.shutdown(wait=True)
+        
+        errors = [f.exception() for f in self.compress_futures]
+        failed = [e for e in errors if e is not None]
+        self.compress_futures = []
+        
+        if failed:
+            if self.metrics is not None:
+                for _ in failed:
+                    self.metrics.error('compress')
+            self.progress_update(
+                'status', 0, 0,
+                msg=f"\n{len(failed)} recording(s) could not be compressed, the wav files may"+
+                    f" be kept instead. First error: {type(failed[0]).__name__}: {failed[0]}\n",
+                )
+        
+        return len(failed)
+    
+    def burst_audio(self, clips):
+        """
+        Concatenate clips into a single transmission.
+        
+        Each clip is followed by burst_guard seconds of silence so that the
+        received clips do not overlap.
+        
+        Parameters
+        ----------
+        clips : list of numpy arrays
+            Audio clips to transmit.
+            
+        Returns
+        -------
+        audio : numpy array
+            Audio for the whole transmission.
+        bounds : list of tuples
+            Start and end sample of each clip in audio.
+        """
+        guard = np.zeros(int(self.burst_guard * self.audio_interface.sample_rate))
+        
+        audio = []
+        bounds = []
+        start = 0
+        for clip in clips:
+            audio.extend((clip, guard))
+            bounds.append((start, start + len(clip)))
+            start += len(clip) + len(guard)
+        
+        return np.concatenate(audio), bounds
+    
+    def split_burst(self, rec_dat, bounds):
+        """
+        Split a burst recording into one recording per clip.
+        
+        Each segment starts where its clip started in the transmission and
+        includes the guard interval after it, so the delay of each segment
+        is the same as for a single clip trial.
+        
+        Parameters
+        ----------
+        rec_dat : numpy array
+            Received audio for the whole transmission.
+        bounds : list of tuples
+            Clip bounds as returned by burst_audio.
+            
+        Returns
+        -------
+        list of numpy arrays
+            Received audio for each clip.
+        """
+        guard = int(self.burst_guard * self.audio_interface.sample_rate)
+        
+        return [rec_dat[start:end + guard] for start, end in bounds]
+    
+    def precharacterize_sweep(self):
+        """
+        Estimate the usable volume range of the channel.
+        
+        A short segment of the first clip is transmitted at cal_steps levels
+        across lim in a single transmission. The received level of each step
+        is compared to the transmit level and to the noise floor of the
+        recording. The usable range starts at the first level that is
+        cal_snr dB above the noise floor and ends where the channel starts
+        to compress or clip. One step of margin is kept on each side.
+        
+        Levels and received levels are written to a '_CAL.csv' file next to
+        the data file.
+        
+        Returns
+        -------
+        list of floats
+            Narrowed volume limits, lim if no usable range was found.
+        """
+        return _drive(self._precharacterize_steps())
+    
+    def _precharacterize_steps(self):
+        """Step generator for precharacterize_sweep."""
+        fs = int(self.audio_interface.sample_rate)
+        levels = np.linspace(self.lim[0], self.lim[1], self.cal_steps)
+        step = levels[1] - levels[0]
+        
+        # Use the loudest cal_len seconds of the first clip
+        clip = mcvqoe.base.audio_float(self.y[0])
+        seg_len = min(len(clip), int(self.cal_len * fs))
+        energy = np.cumsum(np.concatenate(([0], np.square(clip))))
+        seg_start = np.argmax(energy[seg_len:] - energy[:-seg_len])
+        cal = clip[seg_start:seg_start + seg_len]
+        
+        tx_cal, bounds = self.burst_audio(
+            [(10**((lvl - self.dev_volume)/20)) * cal for lvl in levels]
+            )
+        
+        cal_name = os.path.join(self.wav_data_dir, "Cal.wav")
+        
+        yield from self._transmit_steps(tx_cal, cal_name)
+        
+        _, rec_dat = yield partial(mcvqoe.base.audio_read, cal_name)
+        rec_dat = mcvqoe.base.audio_float(rec_dat)
+        if rec_dat.ndim > 1:
+            rec_dat = rec_dat[:, 0]
+        if not self.save_audio:
+            os.remove(cal_name)
+        
+        # RMS of 20 ms frames
+        frame = int(0.02 * fs)
+        
+        # Noise floor from the quietest frames of the whole recording
+        noise_db = np.percentile(frame_levels(rec_dat, frame), 10)
+        
+        # Level of active speech in each step, robust to the unknown delay
+        segs = self.split_burst(rec_dat, bounds)
+        rx_db = np.array([np.percentile(frame_levels(seg, frame), 90) for seg in segs])
+        peak = np.array([np.max(np.abs(seg)) for seg in segs])
+        
+        # Levels that are well above the noise floor
+        above = rx_db > noise_db + self.cal_snr
+        # Received level gain from one step to the next, less than 1/2 is
+        # taken as compression
+        gain = np.diff(rx_db) / step
+        compressed = np.concatenate(([False], gain < 0.5)) | (peak > 0.99)
+        
+        cal_rows = [['Volume', 'Rx_Level [dB]', 'Peak', 'Noise_Floor [dB]']]
+        cal_rows.extend([lvl, lvl_db, pk, noise_db] for lvl, lvl_db, pk in zip(levels, rx_db, peak))
+        yield partial(self.write_csv, os.path.splitext(self.data_filename)[0] + '_CAL.csv', cal_rows)
+        
+        if not np.any(above):
+            return list(self.lim)
+        
+        lo_idx = np.argmax(above)
+        # Compression only counts above the noise floor
+        comp = np.flatnonzero(compressed & above)
+        comp = comp[comp > lo_idx]
+        # The first compressed level is one step above the last linear level
+        hi = levels[comp[0]] if len(comp) else self.lim[1]
+        
+        return [max(self.lim[0], levels[lo_idx] - step), hi]
+    
     def setup_grid(self):
         """Populate array of x-values to evaluate at"""
         
@@ -214,7 +1020,7 @@ class measure:
         """Get the next x value to evaluate at based on new data"""
 
         # Save data with dither noise
-        self.y_values[self.eval_step] = y_vals + np.random.normal(0, 0.05, len(y_vals))
+        self.y_values[self.eval_step] = y_vals + self.rng.normal(0, 0.05, len(y_vals))
         self.x_values[self.eval_step] = eval_x
         
         # Check if we need a new grid
@@ -232,7 +1038,7 @@ class measure:
 
                         perm = perm[0].flatten()
                         # Perform permutation test with values from self.y_values
-                        if not (mcvqoe.math.approx_permutation_test(self.y_values[k], perm)):
+                        if not approx_permutation_test(self.y_values[k], perm, self.rng):
                             self.groups[kk].append(k)
                             # Found! Done
                             found = True
@@ -249,8 +1055,9 @@ class measure:
             
             for k in range(len(self.groups)):
                 # Compute the mean of y-values
+                # Steps can have different numbers of trials in coarse mode
                 y_val_group = [self.y_values[i] for i in self.groups[k]]
-                mean_y[k] = np.mean(y_val_group)
+                mean_y[k] = np.mean(np.concatenate(y_val_group))
                 
             g_score = np.multiply(mean_y, group_size)
             
@@ -313,7 +1120,9 @@ class measure:
         
         # If new evaluation, reset internal values
         if new_eval:
-            self.points = 10
+            if self.rng is None:
+                self.rng = np.random.default_rng(self.seed)
+            self.points = self.grid_points
             self.eval_step = 0
             self.win_found = False
             self.chosen_group = np.nan
@@ -330,7 +1139,8 @@ class measure:
         load audio files for use in test.
         
         this loads audio from self.audio_files and stores values in self.y, and
-        self.cutpoints. In most cases run() will call this automatically but,
+        self.cutpoints. Reference features for each clip are stored in
+        self.clip_refs. In most cases run() will call this automatically but,
         it can be called in the case that self.audio_files is changed after
         run() is called.
 
@@ -412,54 +1222,806 @@ class measure:
             FakeAi = namedtuple('FakeAi', 'sample_rate')
             # Create a fake one
             self.audio_interface = FakeAi(sample_rate = fs_test)
-            
-    def run(self):
         
-        """Run a volume adjust test"""
-
-        #------------------[List Vars to Save in File]------------------
+        # Compute reference features once for each clip
+        self.clip_refs = [clip_reference(y, fs_test) for y in self.y]
+        # Delays of scored trials, used to narrow delay search
+        self.trial_delays = []
+    
+    def score(self, clip_index, rec_dat):
+        """
+        Compute FSF score and delay for a recording of a clip.
         
-        # TODO: Do we want to save our progress in case of error?
-        # save_vars = ('p', 'git_status', 'y', 'dev_name', 'test_dat',
-        #              'fs', 'opt', 'vol_scl_en', 'clipi', 'cutpoints',
-        #              'method')
+        Uses the cached reference features in self.clip_refs. If m2e_window
+        is set, the delay search is narrowed around the median delay of the
+        previous trials. If the narrowed estimate is not reliable or fsf finds
+        the delay at the edge of the trimmed recording the full recording is
+        searched. The full recording is trimmed around its envelope delay
+        first only if self.align is True. The delay is added to
+        self.trial_delays.
         
-        #--------[Save original self.lim for multiple iterations]-------
+        Parameters
+        ----------
+        clip_index : int
+            Index of the transmitted clip in self.y.
+        rec_dat : numpy array
+            Float audio of the recording.
+            
+        Returns
+        -------
+        fsf_score : float
+            FSF score of the recording.
+        dly : int
+            Delay of the recording in samples.
+        """
+        ref = self.clip_refs[clip_index]
+        result = None
         
-        self.lim_orig = self.lim
+        # Need a few trials before the median is meaningful
+        if self.m2e_window is not None and len(self.trial_delays) >= 3:
+            # Delays are in the fsf convention, envelope lags are positive
+            med = -int(np.median(self.trial_delays))
+            win = int(self.m2e_window * ref.fs)
+            dly, conf = ref.delay(rec_dat, lags=(med - win, med + win))
+            if dly is not None and conf >= self.align_threshold:
+                result = ref.score_at(rec_dat, dly, self.align_margin)
+                # fsf can only search the trimmed window, a delay at its edge
+                # means the true delay may be outside of it
+                edge = int(self.align_margin * ref.fs) - ref.env_factor
+                if np.abs(-result[1] - dly) >= edge:
+                    result = None
         
-        #--------------[Multiple iterations loop and try]---------------
+        if result is None and self.align:
+            # Full envelope search, then trim
+            result = ref.score(
+                rec_dat,
+                margin=self.align_margin,
+                threshold=self.align_threshold,
+                )
+        elif result is None:
+            # Score the full recording
+            result = ref.fsf(rec_dat)
         
-        try:
+        self.trial_delays.append(result[1])
+        
+        return result
             
-            for itr in range(self.iterations):
-                
-                # Get back original limits
-                self.lim = self.lim_orig
+    def rx_diagnostics(self, rec_dat):
+        """
+        Compute received signal diagnostics for a recording.
         
-                #--------------[Check for Correct Audio Channels]---------------
-                
-                if('tx_voice' not in self.audio_interface.playback_chans.keys()):
-                    raise ValueError('self.audio_interface must be set up to play tx_voice') 
-                if('rx_voice' not in self.audio_interface.rec_chans.keys()):
-                    raise ValueError('self.audio_interface must be set up to record rx_voice')
+        Parameters
+        ----------
+        rec_dat : numpy array
+            Float audio of the recording.
+            
+        Returns
+        -------
+        peak : float
+            Largest sample magnitude.
+        clip_ratio : float
+            Fraction of samples at or above clip_level.
+        level : float
+            RMS level of the recording in dB.
+        noise_floor : float
+            Level, in dB, of the quietest 10 percent of 20 ms frames.
+        """
+        if rec_dat.ndim > 1:
+            rec_dat = rec_dat[:, 0]
+        if len(rec_dat) == 0:
+            return 0.0, 0.0, -200.0, -200.0
         
-                #---------------------[Get Test Start Time]---------------------
+        mag = np.abs(rec_dat)
+        peak = np.max(mag)
+        clip_ratio = np.count_nonzero(mag >= self.clip_level) / len(mag)
+        level = 20*np.log10(max(np.sqrt(np.mean(np.square(rec_dat))), 1e-10))
         
-                self.info['Tstart'] = datetime.datetime.now()
-                dtn = self.info['Tstart'].strftime('%d-%b-%Y_%H-%M-%S')
+        frames = frame_levels(rec_dat, int(0.02 * self.audio_interface.sample_rate))
+        noise_floor = np.percentile(frames, 10) if len(frames) else level
         
-                #----------------------[Fill Log Entries]-----------------------
-                
-                # Set test name
-                self.info['test'] = 'VolumeAdjust'
-                # Add iteration number
-                self.info['iteration #'] = f"{itr+1} of {self.iterations}"
+        return peak, clip_ratio, level, noise_floor
+    
+    def clip_check(self, vol, step):
+        """
+        Check the trials of an optimizer step for clipping.
+        
+        If the step is clipped and vol is below any clipped volume found so
+        far, vol becomes the clipped volume and the upper limit is lowered to
+        it.
+        
+        Parameters
+        ----------
+        vol : float
+            Volume of the step.
+        step : int
+            Optimizer step the trials are stored under.
+            
+        Returns
+        -------
+        bool
+            True if the step is clipped.
+        """
+        rec = self.trials.records
+        ratio = np.median(rec['Clip_Ratio'][rec['Step'] == step])
+        clipped = ratio > self.clip_threshold
+        
+        if clipped and vol < self.clip_volume:
+            self.clip_volume = vol
+            self.clip_step = step
+            self.lim[1] = max(self.lim[0], min(self.lim[1], vol))
+            self.progress_update(
+                'status', 0, 0,
+                msg=f"\nClipping detected at {vol} dB, upper limit set to {self.lim[1]} dB\n",
+                )
+        
+        return clipped
+    
+    def update_metrics(self, steps_done):
+        """
+        Update session metrics from the optimizer state.
+        
+        Parameters
+        ----------
+        steps_done : int
+            Number of volume steps done in the session.
+        """
+        if self.metrics is None:
+            return
+        
+        gauges = {
+            'session_running': 1,
+            'steps_done': steps_done,
+            'steps_remaining': max(self.smax - steps_done, 0),
+            'interval_lower_db': self.lim[0],
+            'interval_upper_db': self.lim[1],
+            'tol_db': self.tol,
+            }
+        
+        if not self.volumes and not self.per_clip and hasattr(self, 'spacing'):
+            gauges['grid_spacing_db'] = self.spacing
+            gauges['spacing_over_tol'] = self.spacing / self.tol
+            # Points left in this grid, then the spacing is halved for each
+            # new grid until it is below tol. Grids after the first are
+            # about 4 points.
+            in_grid = max(self.start_step + len(self.grid) - self.eval_step, 0)
+            if self.spacing >= self.tol:
+                grids = math.floor(math.log2(self.spacing / self.tol))
+            else:
+                grids = 0
+            gauges['steps_to_converge'] = min(in_grid + 4*grids, gauges['steps_remaining'])
+        
+        self.metrics.set(**gauges)
+        
+    def measure_volume(self, vol, clips, step=-1):
+        """
+        Run trials at a volume and write them to the temporary csv.
+        
+        Trials are added to self.trials and written to the temporary csv
+        together once all trials are done, or when the test is stopped.
+        Recordings are numbered with self.trial_count so that recording
+        numbers follow the order of rows in the csv.
+        
+        Parameters
+        ----------
+        vol : float
+            Volume, in dB, to run trials at.
+        clips : array of ints
+            Index, into self.y, of the clip to play for each trial.
+        step : int, optional
+            Optimizer step the trials are stored under. Defaults to -1.
+            
+        Returns
+        -------
+        numpy array
+            FSF score of each trial.
+        """
+        return _drive(self._measure_volume_steps(vol, clips, step))
+    
+    def _measure_volume_steps(self, vol, clips, step=-1):
+        """Step generator for measure_volume."""
+        
+        start = len(self.trials)
+        t_start = time.monotonic()
+        try:
+            yield from self._volume_trials(vol, clips, step)
+        except BaseException:
+            # Keep the trials that were done
+            self.write_trials(start)
+            raise
+        
+        yield partial(self.write_trials, start)
+        
+        if self.metrics is not None:
+            self.metrics.step_done(time.monotonic() - t_start)
+        
+        return self.trials.records['FSF'][start:].copy()
+    
+    def write_trials(self, start):
+        """Write trials from start to the end of self.trials to the temporary csv."""
+        fields = self.csv_header_fmt()[0].strip().split(',')
+        clip_names = [name.removesuffix('.wav') for name in self.audio_files]
+        self.append_temp(self.trials.csv_rows(start, len(self.trials), fields, clip_names))
+        
+    def _volume_trials(self, vol, clips, step):
+        """Step generator that runs the trials of measure_volume."""
+        
+        # First trial of this volume in the trial store
+        start = len(self.trials)
+        
+        #------------------------[Change Volume]------------------------
+        # Volume is changed by scaling the waveform or prompting the user
+        # to change it in the audio device configuration
+        
+        # Check if we are scaling or using device volume
+        if self.scaling:
+            
+            # Volume that is recorded
+            rec_vol = vol
+            
+            # Scale audio to volume level
+            y_scl = []
+            for jj in range(len(self.y)):
+                y_scl.append((10**((vol-self.dev_volume)/20)) * self.y[jj])
+        
+        else:
+            
+            # Turn on other LED because we are waiting
+            yield partial(self.ri.led, 2, True)
+            
+            # Get volume to set device to
+            d_volume = np.around(vol)
+            
+            # Volume that is recorded
+            rec_vol = d_volume
+
+            # Scale audio volume to make up the difference
+            # Scale audio to volume level
+            y_scl = []
+            for jj in range(len(self.y)):
+                y_scl.append(((10**(vol-d_volume)/20)) * self.y[jj])
+            
+            # Turn off other LED
+            yield partial(self.ri.led, 2, False)
+            
+        #----------------------[Measurement Loop]-----------------------
+
+        # Each transmission plays burst_size clips
+        for kb in range(0, len(clips), self.burst_size):
+            self.progress_update(
+                'diagnose',
+                current_trial=kb,
+                num_trials=len(clips),
+                msg=f"Scaling volume to {vol} dB"
+                )
+            # Trial indices for this transmission
+            burst = range(kb, min(kb + self.burst_size, len(clips)))
+            
+            #---------------------[Get Trial Timestamp]---------------------
+            
+            timestamp = datetime.datetime.now()
+            
+            #------------------[Key Radio and Play Audio]-------------------
+            
+            # Create audiofile names/paths for recordings
+            audionames = [
+                os.path.join(self.wav_data_dir, f"Rx{self.trial_count+kk-kb+1}_{self.audio_files[clips[kk]]}")
+                for kk in burst
+                ]
+            
+            if len(burst) == 1:
+                # Play and record audio data
+                rec_name = yield from self._transmit_steps(y_scl[clips[kb]], audionames[0])
+            else:
+                # Play all clips in one transmission and record to a
+                # burst file that is split below
+                burst_name = os.path.join(self.wav_data_dir, f"Burst{self.trial_count+1}.wav")
+                tx_burst, bounds = self.burst_audio([y_scl[clips[kk]] for kk in burst])
+                rec_name = yield from self._transmit_steps(tx_burst, burst_name)
+            
+            # Increment trial count
+            self.trial_count = self.trial_count + len(burst)
+            
+            #----------------[Volume Level Data Processing]-----------------
+        
+            if len(burst) == 1:
+                # Load audio for processing
+                _, rec_dat = yield partial(mcvqoe.base.audio_read, audionames[0])
+                rec_dat = mcvqoe.base.audio_float(rec_dat)
+                rec_segs = [rec_dat]
+            else:
+                # Load burst and split into a recording per clip
+                _, rec_dat = yield partial(mcvqoe.base.audio_read, burst_name)
+                rec_dat = mcvqoe.base.audio_float(rec_dat)
+                rec_segs = self.split_burst(rec_dat, bounds)
+                os.remove(burst_name)
+                # Save segments so they look like single clip trials
+                if self.save_audio and not self.archive:
+                    for audioname, seg in zip(audionames, rec_segs):
+                        yield partial(mcvqoe.base.audio_write, audioname,
+                                      int(self.audio_interface.sample_rate), seg)
+                
+            channels = mcvqoe.base.audio_channels_to_string(rec_name)
+                
+            for kk, audioname, rec_dat in zip(burst, audionames, rec_segs):
+                
+                for attempt in range(self.max_retries + 1):
+                    # Call fsf method
+                    fsf, dly = yield partial(self.score, clips[kk], rec_dat)
+                    
+                    # Received signal diagnostics
+                    diag = yield partial(self.rx_diagnostics, rec_dat)
+                    
+                    #-----------------------[Calculate M2E]-------------------------
+                    
+                    m2e = np.true_divide(dly, self.audio_interface.sample_rate)
+                    
+                    #----------------------[Check Trial]----------------------------
+                    
+                    prev_fsf = self.trials.records['FSF'][start:]
+                    reason = self.trial_check(fsf, m2e, diag[2], diag[3], prev_fsf)
+                    if reason is None:
+                        break
+                    
+                    retry = attempt < self.max_retries
+                    yield partial(
+                        self.log_bad_trial, self.trial_count - len(burst) + (kk - kb) + 1,
+                        audioname, rec_vol, fsf, m2e, reason, attempt, retry,
+                        )
+                    if not retry:
+                        # Out of retries, keep the trial
+                        break
+                    
+                    # Don't use the delay of a bad trial for later trials
+                    self.trial_delays.pop()
+                    
+                    # Run the trial again
+                    timestamp = datetime.datetime.now()
+                    rec_name = yield from self._transmit_steps(y_scl[clips[kk]], audioname)
+                    _, rec_dat = yield partial(mcvqoe.base.audio_read, audioname)
+                    rec_dat = mcvqoe.base.audio_float(rec_dat)
+                    channels = mcvqoe.base.audio_channels_to_string(rec_name)
+                                           
+                #-----------------------[Store Trial]---------------------------
+                
+                trial = self.trials.add(rec_vol, clips[kk], fsf, m2e, timestamp, channels, step, *diag)
+                if self.metrics is not None:
+                    self.metrics.trial_done()
+                
+                # Compress recording in the background
+                if self.compressing():
+                    self.compress_futures.append(
+                        self.compress_pool.submit(compress_recording, audioname)
+                        )
+                    
+                #-------------------[Add Audio to Archive]--------------------
+                
+                if self.save_audio and self.archive:
+                    yield partial(
+                        self.recording_archive.append,
+                        os.path.basename(audioname),
+                        self.audio_interface.sample_rate,
+                        rec_dat,
+                        Trial=trial + 1,
+                        Filename=self.audio_files[clips[kk]].removesuffix('.wav'),
+                        Volume=rec_vol,
+                        Timestamp=timestamp.strftime("%d-%b-%Y %H:%M:%S"),
+                        )
+                    
+                #------------------[Delete Audio File if needed]-----------------
+                
+                if (not self.save_audio or self.archive) and os.path.exists(audioname):
+                    os.remove(audioname)
+    
+    def _transmit_steps(self, tx_dat, rec_name):
+        """
+        Step generator that keys the radio and plays and records audio.
+        
+        Returns the return value of play_record.
+        """
+        # Push the PTT button
+        yield partial(self.ri.ptt, True)
+        
+        try:
+            # Pause to let the radio key up
+            yield _wait(self.ptt_wait)
+            
+            # Play and record audio data
+            rec = yield partial(self.audio_interface.play_record, tx_dat, rec_name)
+        except GeneratorExit:
+            # Generator is closed, steps can't be yielded
+            self.ri.ptt(False)
+            raise
+        except BaseException:
+            # Release the PTT button, even if the test is stopped
+            yield partial(self.ri.ptt, False)
+            raise
+        
+        # Release the PTT button
+        yield partial(self.ri.ptt, False)
+        
+        # Pause between runs
+        yield _wait(self.ptt_gap)
+        
+        return rec
+    
+    def trial_check(self, fsf, m2e, level, noise_floor, prev_fsf):
+        """
+        Check if a trial looks like a failed transmission.
+        
+        Parameters
+        ----------
+        fsf : float
+            FSF score of the trial.
+        m2e : float
+            Mouth to ear latency of the trial in seconds.
+        level : float
+            RMS level of the recording in dB.
+        noise_floor : float
+            Noise floor of the recording in dB, see rx_diagnostics.
+        prev_fsf : numpy array
+            FSF scores of earlier trials at the same volume.
+            
+        Returns
+        -------
+        str or None
+            Reason the trial is bad, None if the trial looks good.
+        """
+        # Nothing but noise was received
+        if level - noise_floor < self.min_rx_snr:
+            return 'Low Rx level'
+        
+        # Delay of this trial is the last one in trial_delays
+        prev_dly = self.trial_delays[:-1]
+        if len(prev_dly) >= self.check_min_trials:
+            med_m2e = np.median(prev_dly) / self.audio_interface.sample_rate
+            if np.abs(m2e - med_m2e) > self.m2e_tol:
+                return 'M2E latency'
+        
+        if len(prev_fsf) >= self.check_min_trials:
+            med_fsf = np.median(prev_fsf)
+            # Scaled MAD estimate of standard deviation
+            mad = 1.4826 * np.median(np.abs(prev_fsf - med_fsf))
+            if mad > 0 and np.abs(fsf - med_fsf) > self.fsf_outlier * mad:
+                return 'FSF outlier'
+        
+        return None
+    
+    def log_bad_trial(self, trial, audioname, vol, fsf, m2e, reason, attempt, retry):
+        """
+        Log a bad trial to the bad data csv.
+        
+        If the trial is retried, the recording is kept as a 'Bad' file when
+        audio is saved to wav files, otherwise it is deleted.
+        
+        Parameters
+        ----------
+        trial : int
+            Trial number.
+        audioname : str
+            Path of the trial recording.
+        vol : float
+            Volume of the trial.
+        fsf : float
+            FSF score of the trial.
+        m2e : float
+            Mouth to ear latency of the trial in seconds.
+        reason : str
+            Reason the trial is bad.
+        attempt : int
+            Number of retries before this attempt.
+        retry : bool
+            True if the trial is retried.
+        """
+        if self.metrics is not None:
+            self.metrics.error('bad_trial')
+        
+        bad_audio = ''
+        if retry and os.path.exists(audioname):
+            if self.save_audio and not self.archive:
+                bad_audio = f"Bad{trial}_{attempt+1}_{os.path.basename(audioname).split('_', 1)[1]}"
+                os.replace(audioname, os.path.join(self.wav_data_dir, bad_audio))
+            else:
+                os.remove(audioname)
+        
+        new_file = not os.path.exists(self.bad_data_filename)
+        with open(self.bad_data_filename, "a", newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            if new_file:
+                writer.writerow(['Timestamp', 'Trial', 'Filename', 'Volume', 'FSF',
+                                 'm2e_latency', 'Reason', 'Attempt', 'Retried', 'Audio'])
+            writer.writerow([
+                datetime.datetime.now().strftime("%d-%b-%Y %H:%M:%S"), trial,
+                os.path.basename(audioname).split('_', 1)[1].removesuffix('.wav'),
+                vol, fsf, m2e, reason, attempt, retry, bad_audio,
+                ])
+    
+    def append_temp(self, text):
+        """Append text to the temporary csv file."""
+        with open(self.temp_data_filename, "at") as f:
+            f.write(text)
+    
+    @staticmethod
+    def write_csv(filename, rows):
+        """Write rows to a new csv file."""
+        with open(filename, "w") as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerows(rows)
+    
+    def write_data_file(self, opt):
+        """
+        Write the data file from the temporary csv and remove the temporary csv.
+        
+        Parameters
+        ----------
+        opt : float
+            Optimal volume, written above the data with the interval.
+        """
+        with open(self.data_filename, "w") as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['Optimum [dB]', 'Lower_Interval [dB]', 'Upper_Interval [dB]'])
+            writer.writerow([opt, self.lim[0], self.lim[1]])
+            with open(self.temp_data_filename, 'r') as tf:
+                for row in csv.reader(tf):
+                    writer.writerow(row)
+        
+        # Delete our temporary csv file
+        os.remove(self.temp_data_filename)
+        
+    def top_up(self, volume, data_steps, clipi):
+        """
+        Run the rest of the trials for coarse volumes in the current interval.
+        
+        Volumes inside self.lim with fewer than ptt_rep trials get more
+        trials, and the optimizer data for them is updated so later grouping
+        uses all trials.
+        
+        Parameters
+        ----------
+        volume : list of floats
+            Volumes of the steps done so far.
+        data_steps : list of ints
+            Step in self.trials that holds the trials of each step. Steps
+            that reuse data from another step point to that step.
+        clipi : numpy array
+            Clip index for each of the ptt_rep trials.
+        """
+        return _drive(self._top_up_steps(volume, data_steps, clipi))
+    
+    def _top_up_steps(self, volume, data_steps, clipi):
+        """Step generator for top_up."""
+        for j, vol in enumerate(volume):
+            step = data_steps[j]
+            n = len(self.trials.step_fsf(step))
+            if (n >= self.ptt_rep or np.ma.is_masked(vol)
+                    or not (self.lim[0] <= vol <= self.lim[1])):
+                continue
+            # Steps that repeated a volume share a step, it is topped up here
+            # and has enough trials when it comes up again
+            yield from self._measure_volume_steps(vol, clipi[n:], step)
+        
+        # Update optimizer data from the store, with dither noise
+        for j in range(len(volume)):
+            fsf = self.trials.step_fsf(data_steps[j])
+            if len(fsf) != len(self.y_values[j]):
+                self.y_values[j] = fsf + self.rng.normal(0, 0.05, len(fsf))
+        
+    def per_clip_loop(self):
+        """
+        Find the optimal volume for each clip in a single session.
+        
+        Each clip has its own optimizer. At every step each optimizer requests
+        a volume, and clips whose requested volumes are within tol of each
+        other share a volume change and interleave their trials. Each clip
+        gets ptt_rep divided by the number of clips trials per volume, so a
+        step takes about as long as a step with a single optimizer.
+        
+        The optimum and interval for each clip are stored in self.clip_opt
+        and self.clip_lim and written to a csv next to the data file.
+        
+        Returns
+        -------
+        float
+            Mean of the per clip optimal volumes. self.lim is set to the mean
+            of the per clip intervals.
+        """
+        return _drive(self._per_clip_steps())
+    
+    def _per_clip_steps(self):
+        """Step generator for per_clip_loop."""
+        
+        n_clips = len(self.y)
+        reps = max(1, self.ptt_rep // n_clips)
+        
+        # Optimizers for each clip share settings and random generator
+        optimizers = [
+            measure(lim=list(self.lim), tol=self.tol, smax=self.smax, ptt_rep=reps,
+                    grid_points=self.grid_points, rng=self.rng,
+                    progress_update=self.progress_update)
+            for c in range(n_clips)
+            ]
+        volume = [[] for c in range(n_clips)]
+        eval_dat = [[] for c in range(n_clips)]
+        
+        for k in range(self.smax):
+            
+            self.update_metrics(k)
+            
+            #----------------[Compute Next Sample Points]-----------------
+            
+            requests = []
+            for c, optimizer in enumerate(optimizers):
+                if k == 0:
+                    vol = optimizer.opt_vol_pnt(new_eval=True)
+                else:
+                    vol, _ = optimizer.get_next(volume[c][k-1], eval_dat[c][k-1])
+                
+                # Reuse data when a clip repeats a volume
+                idx = next((i for i, v in enumerate(volume[c])
+                            if np.absolute(vol - v) < self.tol), None)
+                if idx is not None:
+                    volume[c].append(vol)
+                    eval_dat[c].append(eval_dat[c][idx])
+                elif np.ma.is_masked(vol):
+                    # Grid point is a repeat, no new information
+                    volume[c].append(vol)
+                    eval_dat[c].append(eval_dat[c][k-1])
+                else:
+                    requests.append((vol, c))
+            
+            #-------------------[Shared Volume Steps]---------------------
+            
+            requests.sort()
+            while requests:
+                vol = requests[0][0]
+                # Clips with coinciding volumes share trials
+                group = [c for v, c in requests if np.absolute(v - vol) < self.tol]
+                requests = [(v, c) for v, c in requests if c not in group]
+                
+                clips = np.tile(group, reps)
+                fsf_dat = yield from self._measure_volume_steps(vol, clips, k)
+                
+                for c in group:
+                    volume[c].append(vol)
+                    eval_dat[c].append(fsf_dat[clips == c])
+        
+        #-------------------[Per Clip Optimal Volume]---------------------
+        
+        self.clip_opt = [o.get_opt() for o in optimizers]
+        self.clip_lim = [list(o.lim) for o in optimizers]
+        
+        clip_name = os.path.splitext(self.data_filename)[0] + '_clips.csv'
+        clip_rows = [['Filename', 'Optimum [dB]', 'Lower_Interval [dB]', 'Upper_Interval [dB]']]
+        clip_rows.extend([name.removesuffix('.wav'), opt, lim[0], lim[1]]
+                         for name, opt, lim in zip(self.audio_files, self.clip_opt, self.clip_lim))
+        yield partial(self.write_csv, clip_name, clip_rows)
+        
+        self.lim = list(np.mean(self.clip_lim, axis=0))
+        
+        return np.nanmean(self.clip_opt)
+        
+    def run(self):
+        
+        """Run a volume adjust test"""
+        
+        self.profiler = session_profiler() if self.profiling else None
+        _drive(self._run_steps(), self.profiler)
+        
+    async def run_async(self, executor=None):
+        """
+        Run a volume adjust test as a coroutine.
+        
+        PTT waits and pauses are awaited with asyncio.sleep. Radio interface
+        calls, play/record, file I/O, scoring, the optimizer, logging and
+        get_post_notes are run in executor, so many tests can run from one
+        event loop without stalling each other. get_post_notes must be safe
+        to call from a worker thread.
+        
+        If the task is cancelled, a play/record that is in progress is
+        allowed to finish, then the radio is unkeyed, LED 1 is turned off,
+        data collected so far is left in the temporary csv and the test is
+        post-logged.
+        
+        When profiling is True only phase times are saved, cProfile is not
+        used because it would profile every task on the event loop.
+        
+        Parameters
+        ----------
+        executor : concurrent.futures.Executor, optional
+            Executor for blocking operations. Defaults to the event loop
+            default executor.
+        """
+        
+        self.profiler = session_profiler(cprofile=False) if self.profiling else None
+        await _drive_async(self._run_steps(), executor, self.profiler)
+        
+    def _run_steps(self):
+        """Step generator for run."""
+
+        #------------------[List Vars to Save in File]------------------
+        
+        # TODO: Do we want to save our progress in case of error?
+        # save_vars = ('p', 'git_status', 'y', 'dev_name', 'test_dat',
+        #              'fs', 'opt', 'vol_scl_en', 'clipi', 'cutpoints',
+        #              'method')
+        
+        #--------[Save original self.lim for multiple iterations]-------
+        
+        self.lim_orig = self.lim
+        
+        #-------------------[Seed Random Generator]---------------------
+        
+        # Generate a seed if none was given, it is written to the log
+        if self.seed is None:
+            self.seed = np.random.SeedSequence().entropy
+        self.rng = np.random.default_rng(self.seed)
+        
+        #----------------------[Start Metrics]-------------------------
+        
+        if self.metrics_port is not None:
+            self.metrics = session_metrics(station=self.info.get('Test Type', ''))
+            server = metrics_server(self.metrics, self.metrics_port, host=self.metrics_host)
+        else:
+            self.metrics = server = None
+        
+        #--------------[Multiple iterations loop and try]---------------
+        
+        try:
+            
+            for itr in range(self.iterations):
+                
+                # Get back original limits
+                self.lim = list(self.lim_orig)
+                
+                #-----------------[Warm Start From Profile]-----------------
+                
+                if self.use_profile and not self.volumes:
+                    profiles = yield partial(device_profiles, self.profile_path)
+                    profile_key = device_profiles.key(
+                        self.info, self.audio_files, self.audio_interface.sample_rate
+                        )
+                    if profile_key is None:
+                        warn("Tx Device and Rx Device must be given in info to use device profiles. Profile not used.")
+                        prior = None
+                    else:
+                        prior = profiles.prior(profile_key, margin=self.profile_margin,
+                                               bounds=self.lim_orig)
+                    if prior is not None:
+                        self.lim = prior
+                        self.progress_update(
+                            'status', 0, 0,
+                            msg=f"\nUsing starting interval [{prior[0]}, {prior[1]}] from device profile\n",
+                            )
+                
+                # Delay history, trial count and clipping are per session
+                self.trial_delays = []
+                self.trial_count = 0
+                self.clip_volume = np.inf
+                self.clip_step = None
+        
+                #--------------[Check for Correct Audio Channels]---------------
+                
+                if('tx_voice' not in self.audio_interface.playback_chans.keys()):
+                    raise ValueError('self.audio_interface must be set up to play tx_voice') 
+                if('rx_voice' not in self.audio_interface.rec_chans.keys()):
+                    raise ValueError('self.audio_interface must be set up to record rx_voice')
+        
+                #---------------------[Get Test Start Time]---------------------
+        
+                self.info['Tstart'] = datetime.datetime.now()
+                dtn = self.info['Tstart'].strftime('%d-%b-%Y_%H-%M-%S')
+        
+                #----------------------[Fill Log Entries]-----------------------
+                
+                # Set test name
+                self.info['test'] = 'VolumeAdjust'
+                # Add iteration number
+                self.info['iteration #'] = f"{itr+1} of {self.iterations}"
                 # Save blocksize and buffersize for log output
                 self.blocksize = self.audio_interface.blocksize
                 self.buffersize = self.audio_interface.buffersize
                 # Fill in standard stuff
-                self.info.update(mcvqoe.base.write_log.fill_log(self))
+                log_info = yield partial(mcvqoe.base.write_log.fill_log, self)
+                self.info.update(log_info)
         
                 #--------------[Initialize Folders and Filenames]---------------
                 
@@ -495,11 +2057,18 @@ class measure:
                 file = os.path.join(self.data_dirs[itr], file)
                 tmp_f = os.path.join(self.data_dirs[itr], tmp_f)
                 self.data_filename = file
-                temp_data_filename = tmp_f
+                self.temp_data_filename = tmp_f
+                self.wav_data_dir = wavdir
+                
+                #--------------------[Start Profiling]--------------------------
+                
+                if self.profiler is not None:
+                    self.profiler.start()
                     
                 # Generate filename for bad csv data
                 bad_name = f"{base_filename}_BAD.csv"
                 bad_name = os.path.join(self.data_dirs[itr], bad_name)
+                self.bad_data_filename = bad_name
                 
                 #--------------------[Generate CSV Header]----------------------
                 
@@ -507,16 +2076,36 @@ class measure:
                 
                 #-----------------[Load Audio Files if Needed]------------------
                 
-                if not hasattr(self, "y"):
-                    self.load_audio()
+                if not hasattr(self, "y") or not hasattr(self, "clip_refs"):
+                    yield self.load_audio
                 
                 #-------------------[Add Tx Audio to WAV Dir]-------------------
                 
+                if self.compressing():
+                    # Single worker so compression doesn't compete with the test
+                    self.compress_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                    self.compress_futures = []
+                
+                if self.save_audio and self.archive:
+                    # Recordings go in a single archive instead of wav files
+                    self.recording_archive = recording_archive(
+                        wavdir, mode='a',
+                        meta_fields=('Trial', 'Filename', 'Volume', 'Timestamp'),
+                        )
+                
                 if self.save_tx_audio and self.save_audio:
                     # Write out Tx clips to files
                     for dat, name in zip(self.y, clip_names):
                         out_name = os.path.join(wavdir, f"Tx_{name}")
-                        mcvqoe.base.audio_write(out_name + ".wav", int(self.audio_interface.sample_rate), dat)
+                        if self.archive:
+                            yield partial(
+                                self.recording_archive.append,
+                                f"Tx_{name}.wav", self.audio_interface.sample_rate,
+                                mcvqoe.base.audio_float(dat),
+                                )
+                        else:
+                            yield partial(mcvqoe.base.audio_write, out_name + ".wav",
+                                          int(self.audio_interface.sample_rate), dat)
                 
                 #-------------------[Get Max Number of Loops]-------------------
                 
@@ -525,21 +2114,24 @@ class measure:
                     
                 #-----------------------[write log entry]-----------------------
                 
-                mcvqoe.base.pre(info=self.info, outdir=self.outdir, test_folder=self.data_dirs[itr])
+                yield partial(mcvqoe.base.pre, info=self.info, outdir=self.outdir,
+                              test_folder=self.data_dirs[itr])
                 
                 #-----------------[Create Arrays & Variables]-------------------
                 
+                # Trial results for the session
+                self.trials = trial_store(self.smax * self.ptt_rep)
+                
                 # Arrays
                 volume = []
-                eval_vals = [0.0 for i in range(self.smax)]
-                eval_dat = [[0.0 for j in range(self.ptt_rep)] for i in range(self.smax)]
+                # Step in self.trials holding the trials of each step
+                data_steps = []
                 
                 # Used to cycle between audiofiles
                 clipi = np.mod(range(self.ptt_rep), len(self.y))
                 
                 # Variables
                 opt = np.nan
-                trial_count = 0
                 
                 # Setup for Optimization Method
                 if self.volumes:
@@ -557,220 +2149,215 @@ class measure:
                     
                 
                 # Turn on LED
-                self.ri.led(1, True)
+                yield partial(self.ri.led, 1, True)
+                
+                #----------------[Channel Precharacterization]------------------
+                
+                if self.precharacterize and self.scaling and not self.volumes:
+                    self.lim = yield from self._precharacterize_steps()
+                    self.progress_update(
+                        'status', 0, 0,
+                        msg=f"\nPrecharacterization interval: [{self.lim[0]}, {self.lim[1]}]\n",
+                        )
                     
                 #----------------------[Write CSV Header]-----------------------
                 
-                with open(temp_data_filename, "wt") as f:
-                    f.write(header)
+                yield partial(self.write_csv, self.temp_data_filename, [header.strip().split(',')])
                 
                 #--------------------[Volume Selection Loop]--------------------
                 
-                for k in range(self.smax):
-                    
-                    #------------------[Initialize CSV Dictionary]------------------
-                        
-                    csv_data = {}
+                if self.per_clip and not self.volumes:
+                    # Independent optimizer for each clip
+                    opt = yield from self._per_clip_steps()
+                else:
+                    # Use fewer trials until the initial grid is done
+                    coarse = bool(self.coarse_rep) and not self.volumes
                     
-                    #------------------[Compute Next Sample Point]------------------
+                    for k in range(self.smax):
                     
-                    # Check if volumes were given
-                    if not self.volumes:
-                        if k == 0:
-                            # Initial run initialization
-                            volume.append(self.opt_vol_pnt(new_eval=True))
-                            # Can't be done before we start
-                            done = False
-                        else:
-                            # Process data and get next point
-                            new_vol, done = self.get_next(volume[k-1], eval_dat[k-1])
-                            volume.append(new_vol)
-                            
-                        # TODO Check for convergence
-                        if(done):
-                            self.progress_update(
-                                'status', 0, 0,
-                                msg="Checked for convergence",
-                                )
-                            
-                    #------------------------[Skip Repeats]-------------------------
+                        #------------------[Compute Next Sample Point]------------------
                     
-                    # Check if volumes were given
-                    if not self.volumes:
-                        # Check to see if we are evaluating a value that has been done before
-                        # abs = [(np.absolute(volume[k] - vol) == (self.tol/1000)) for vol in volume[0:k]]
-                        abs = [(np.absolute(volume[k] - vol) < self.tol) for vol in volume[0:k]]
-                        if len(abs) > 0:
-                            
-                            try:
-                                idx = next(x[0] for x in enumerate(abs) if x[1] == True)
-                            except StopIteration:
-                                idx = np.nan
+                        # Check if volumes were given
+                        if not self.volumes:
+                            if k == 0:
+                                # Initial run initialization
+                                volume.append(self.opt_vol_pnt(new_eval=True))
+                                # Can't be done before we start
+                                done = False
+                            else:
+                                # Process data and get next point
+                                grid_start = self.start_step
+                                new_vol, done = yield partial(
+                                    self.get_next, volume[k-1], self.trials.step_fsf(data_steps[k-1])
+                                    )
+                                volume.append(new_vol)
+                                
+                                # Keep the interval below clipped volumes
+                                if self.clip_prune:
+                                    self.lim[1] = max(self.lim[0], min(self.lim[1], self.clip_volume))
                                 
-                            # Check if value was found
-                            if not np.isnan(idx):
+                                # Check if the initial grid is done
+                                if coarse and self.start_step != grid_start:
+                                    coarse = False
+                                    yield from self._top_up_steps(volume[:k], data_steps, clipi)
+                            
+                            # TODO Check for convergence
+                            if(done):
                                 self.progress_update(
                                     'status', 0, 0,
-                                    msg=f"\nRepeating volume of {volume[k]}, using volume from run {idx+1},"+
-                                         " skipping to next iteration...\n",
+                                    msg="Checked for convergence",
                                     )
-    
-                                # Copy old values
-                                eval_vals[k] = eval_vals[idx]
-                                eval_dat[k] = eval_dat[idx]
-                                # Skip to next iteration
-                                continue
-                        
-                    #------------------------[Change Volume]------------------------
-                    # Volume is changed by scaling the waveform or prompting the user
-                    # to change it in the audio device configuration
-                    
-                    # Check if we are scaling or using device volume
-                    if self.scaling:
-                        
-                        # Add volume to dictionary
-                        csv_data['Volume'] = volume[k]
+                            
+                        self.update_metrics(k)
                         
-                        # Scale audio to volume level
-                        y_scl = []
-                        for jj in range(len(self.y)):
-                            y_scl.append((10**((volume[k]-self.dev_volume)/20)) * self.y[jj])
+                        #------------------------[Skip Repeats]-------------------------
                     
-                    else:
-                        
-                        # Turn on other LED because we are waiting
-                        self.ri.led(2, True)
-                        
-                        # Get volume to set device to
-                        d_volume = np.around(volume[k])
-                        
-                        # Add volume to dictionary
-                        csv_data['Volume'] = d_volume
-
-                        # Scale audio volume to make up the difference
-                        # Scale audio to volume level
-                        y_scl = []
-                        for jj in range(len(self.y)):
-                            y_scl.append(((10**(volume[k]-d_volume)/20)) * self.y[jj])
-                        
-                        # Turn off other LED
-                        self.ri.led(2, False)
-                        
-                    #----------------------[Measurement Loop]-----------------------
+                        # Check if volumes were given
+                        if not self.volumes:
+                            # Check to see if we are evaluating a value that has been done before
+                            # abs = [(np.absolute(volume[k] - vol) == (self.tol/1000)) for vol in volume[0:k]]
+                            abs = [(np.absolute(volume[k] - vol) < self.tol) for vol in volume[0:k]]
+                            if len(abs) > 0:
+                            
+                                try:
+                                    idx = next(x[0] for x in enumerate(abs) if x[1] == True)
+                                except StopIteration:
+                                    idx = np.nan
+                                
+                                # Check if value was found
+                                if not np.isnan(idx):
+                                    self.progress_update(
+                                        'status', 0, 0,
+                                        msg=f"\nRepeating volume of {volume[k]}, using volume from run {idx+1},"+
+                                             " skipping to next iteration...\n",
+                                        )
     
-                    for kk in range(self.ptt_rep):
-                        self.progress_update(
-                            'diagnose',
-                            current_trial=kk,
-                            num_trials=self.ptt_rep,
-                            msg=f"Scaling volume to {volume[k]} dB"
-                            )
-                        #---------------------[Get Trial Timestamp]---------------------
-                        
-                        csv_data['Timestamp'] = datetime.datetime.now().strftime("%d-%b-%Y %H:%M:%S")
-                        
-                        #------------------[Key Radio and Play Audio]-------------------
-                        
-                        # Push the PTT button
-                        self.ri.ptt(True)
-                    
-                        # Pause to let the radio key up
-                        time.sleep(self.ptt_wait)
-                        
-                        # Create audiofile name/path for recording
-                        audioname = f"Rx{(k*self.ptt_rep)+(kk+1)}_{self.audio_files[clipi[kk]]}"
-                        audioname = os.path.join(wavdir, audioname)
+                                    # Use trials from the old step
+                                    data_steps.append(data_steps[idx])
+                                    # Skip to next iteration
+                                    continue
                         
-                        # Play and record audio data
-                        rec_name = self.audio_interface.play_record(y_scl[clipi[kk]], audioname)
+                        #----------------------[Skip Clipped]---------------------------
                         
-                        # Release the PTT button
-                        self.ri.ptt(False)
-                        
-                        # Pause between runs
-                        time.sleep(self.ptt_gap)
-                        
-                        # Increment trial count
-                        trial_count = trial_count + 1
+                        prune = self.clip_prune and not self.volumes
+                        if prune and volume[k] >= self.clip_volume:
+                            self.progress_update(
+                                'status', 0, 0,
+                                msg=f"\nVolume of {volume[k]} is above clipped volume {self.clip_volume},"+
+                                     " using clipped data, skipping to next iteration...\n",
+                                )
+                            data_steps.append(data_steps[self.clip_step])
+                            continue
                         
-                        #----------------[Volume Level Data Processing]-----------------
+                        #----------------------[Measurement Loop]-----------------------
                     
-                        # Load audio for processing
-                        _, rec_dat = mcvqoe.base.audio_read(audioname)
-                        rec_dat = mcvqoe.base.audio_float(rec_dat)
-                    
-                        # Call fsf method
-                        eval_dat[k][kk], dly = mcvqoe.base.fsf(self.y[clipi[kk]], rec_dat)
-                        
-                        #-----------------------[Calculate M2E]-------------------------
-                        
-                        csv_data['m2e_latency'] = np.true_divide(dly, self.audio_interface.sample_rate)
-                                                   
-                        #------------------------[Write to CSV]-------------------------
-                        
-                        # Place info inside Dictionary
-                        suffix_removed = self.audio_files[clipi[kk]].removesuffix('.wav')
-                        csv_data['Filename'] = suffix_removed
-                        csv_data['Channels'] = mcvqoe.base.audio_channels_to_string(rec_name)
-                        csv_data['FSF'] = eval_dat[k][kk]
-                        
-                        # Write to CSV
-                        with open(temp_data_filename, "at") as f:
-                            f.write(
-                                dat_format.format(**csv_data)
-                            )
-                            
-                        #------------------[Delete Audio File if needed]-----------------
-                        
-                        if not self.save_audio:
-                            os.remove(audioname)
+                        reps = self.coarse_rep if coarse else self.ptt_rep
+                        data_steps.append(k)
+                        yield from self._measure_volume_steps(volume[k], clipi[:reps], k)
                         
-                    # Compute mean of FSF values                                          
-                    eval_vals[k] = np.mean(eval_dat[k])
+                        if prune:
+                            self.clip_check(volume[k], k)
                     
                     
-                # Calculate optimal volume
-                if not self.volumes:
-                    opt = self.get_opt()
-                else:
-                    opt = np.nan
+                    # Calculate optimal volume
+                    if not self.volumes:
+                        opt = self.get_opt()
+                    else:
+                        opt = np.nan
                 
                 # -------------------------[Cleanup]----------------------------
+                
+                # Wait for compression to finish
+                if self.compressing():
+                    yield partial(self.drain_compress)
     
                 # Copy temp file to final file and add optimal findings
-                with open(self.data_filename, "w") as f:
-                    writer = csv.writer(f, lineterminator='\n')
-                    writer.writerow(['Optimum [dB]', 'Lower_Interval [dB]', 'Upper_Interval [dB]'])
-                    writer.writerow([opt, self.lim[0], self.lim[1]])
-                    for row in csv.reader(open(temp_data_filename, 'r')):
-                        writer.writerow(row)
-                
-                # Delete our temporary csv file
-                os.remove(temp_data_filename)
+                yield partial(self.write_data_file, opt)
                 
                 # Turn off RI LED
-                self.ri.led(1, False)
+                yield partial(self.ri.led, 1, False)
                 
                 # Save opt and lim for multiple iterations
                 self.opt_save.append(opt)
                 self.lim_save.append(self.lim)
-  
-        finally:
-            if self.get_post_notes:
-                # Get notes
-                info = {}
-                info.update(self.get_post_notes())
-                for itrr in range(len(self.lim_save)):
-                    
-                    info["opt"] = self.opt_save[itrr]
-                    info["lowint"] = self.lim_save[itrr][0]
-                    info["upint"] = self.lim_save[itrr][1]
-                    self.post(info=info, outdir=self.outdir, test_folder=self.data_dirs[itrr])
+                
+                # Add result to device profile
+                if (self.use_profile and not self.volumes and profile_key is not None
+                        and not np.isnan(opt)):
+                    yield partial(profiles.add, profile_key, opt, self.lim)
+                
+                # Save session profile
+                if self.profiler is not None:
+                    yield partial(self.save_profile)
+                
+                # Session is done
+                if self.metrics is not None:
+                    self.metrics.set(session_running=0, steps_remaining=0)
+        
+        except GeneratorExit:
+            # Generator is closed, steps can't be yielded so clean up here
+            _drive(self._finish_steps(server))
+            raise
+        
+        except BaseException as e:
+            if self.metrics is not None and isinstance(e, Exception):
+                self.metrics.error('session')
+            yield from self._finish_steps(server)
+            raise
+        
+        yield from self._finish_steps(server)
+    
+    def _finish_steps(self, server):
+        """
+        Step generator that cleans up and post-logs a test.
+        
+        Runs when a test finishes, fails or is stopped.
+        
+        Parameters
+        ----------
+        server : metrics_server or None
+            Metrics server to stop.
+        """
+        # Turn off RI LED, it is left on if the test was stopped
+        if self.ri is not None and len(self.data_dirs) > len(self.lim_save):
+            yield partial(self.ri.led, 1, False)
+        
+        # Let pending compression finish
+        if hasattr(self, 'compress_pool'):
+            yield partial(self.drain_compress)
+        
+        # Stop serving metrics
+        if server is not None:
+            yield partial(server.stop_serving)
+        
+        # Save profile of a session that was stopped
+        if self.profiler is not None and self.profiler.running:
+            yield partial(self.save_profile)
+        
+        info = {}
+        if self.get_post_notes:
+            # Get notes
+            notes = yield partial(self.get_post_notes)
+            info.update(notes)
+        for itrr in range(len(self.data_dirs)):
+            if itrr < len(self.lim_save):
+                info["opt"] = self.opt_save[itrr]
+                info["lowint"] = self.lim_save[itrr][0]
+                info["upint"] = self.lim_save[itrr][1]
             else:
-                info = {}
-                for itrr in range(len(self.data_dirs)):
-                    self.post(info=info, outdir=self.outdir, test_folder=self.data_dirs[itrr])
-            
+                # Iteration was stopped before it finished
+                info["opt"] = info["lowint"] = info["upint"] = np.nan
+            yield partial(self.post, info=dict(info), outdir=self.outdir,
+                          test_folder=self.data_dirs[itrr])
+        
+    def save_profile(self):
+        """Save the session profile next to the data file."""
+        prof_name = self.profiler.save(os.path.splitext(self.data_filename)[0])
+        self.progress_update(
+            'status', 0, 0,
+            msg=f"Session profile written to {prof_name}",
+            )
+    
     @staticmethod
     def included_audio_path():
         """
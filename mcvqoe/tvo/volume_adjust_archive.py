@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Single container archive for TVO recordings.
+
+Recordings are appended to one binary data file as float32 samples and
+indexed in a csv file that gives the position, shape and sample rate of each
+recording along with per-trial metadata. Any recording can be read without
+reading the others.
+"""
+
+import csv
+import os
+
+import numpy as np
+
+# Name of archive files, without extension
+archive_name = 'recordings'
+
+# Index fields that are always present
+_index_fields = ('Name', 'Offset', 'Samples', 'Channels', 'fs')
+
+
+class recording_archive:
+    """
+    Archive of recordings in a single data file with a csv index.
+
+    Parameters
+    ----------
+    path : str
+        Folder containing the archive.
+    mode : str, optional
+        'r' to read an existing archive, 'a' to append to an archive,
+        creating it if needed. Defaults to 'r'.
+    meta_fields : list of str, optional
+        Names of metadata fields stored with each recording. Only used when
+        a new archive is created. Defaults to no metadata.
+
+    Attributes
+    ----------
+    data_path : str
+        Path to the binary data file.
+    index_path : str
+        Path to the csv index file.
+    index : dict
+        Index entry for each recording name.
+    """
+
+    def __init__(self, path, mode='r', meta_fields=()):
+        self.data_path = os.path.join(path, archive_name + '.bin')
+        self.index_path = os.path.join(path, archive_name + '.csv')
+        self.mode = mode
+        self.index = {}
+        self.fields = list(_index_fields) + list(meta_fields)
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', newline='') as f:
+                reader = csv.DictReader(f)
+                self.fields = reader.fieldnames
+                for row in reader:
+                    self.index[row['Name']] = row
+        elif mode == 'r':
+            raise FileNotFoundError(f'No recording archive in {path}')
+        else:
+            with open(self.index_path, 'w', newline='') as f:
+                csv.DictWriter(f, self.fields, lineterminator='\n').writeheader()
+
+        if os.path.exists(self.data_path):
+            self.size = os.path.getsize(self.data_path)
+        else:
+            self.size = 0
+
+    @staticmethod
+    def exists(path):
+        """Return True if there is an archive in the folder path."""
+        return os.path.exists(os.path.join(path, archive_name + '.csv'))
+
+    def names(self):
+        """Return the names of all recordings in the archive, in order."""
+        return list(self.index.keys())
+
+    def append(self, name, fs, data, **meta):
+        """
+        Append a recording to the archive.
+
+        Parameters
+        ----------
+        name : str
+            Name of the recording, usually the wav file name it replaces.
+        fs : int
+            Sample rate of the recording.
+        data : numpy array
+            Float audio, one column per channel for multichannel audio.
+        **meta
+            Metadata for the recording, keys must be in the metadata fields.
+        """
+        if self.mode == 'r':
+            raise RuntimeError('Archive was opened for reading')
+
+        data = np.asarray(data, dtype=np.float32)
+        channels = 1 if data.ndim == 1 else data.shape[1]
+
+        with open(self.data_path, 'ab') as f:
+            f.write(data.tobytes())
+
+        entry = {
+            'Name': name,
+            'Offset': self.size,
+            'Samples': len(data),
+            'Channels': channels,
+            'fs': int(fs),
+            **meta,
+            }
+        self.size += data.nbytes
+
+        with open(self.index_path, 'a', newline='') as f:
+            csv.DictWriter(f, self.fields, lineterminator='\n').writerow(entry)
+
+        self.index[name] = {k: str(v) for k, v in entry.items()}
+
+    def read(self, name):
+        """
+        Read a recording from the archive.
+
+        Parameters
+        ----------
+        name : str
+            Name of the recording.
+
+        Returns
+        -------
+        fs : int
+            Sample rate of the recording.
+        data : numpy array
+            Float audio of the recording.
+        """
+        entry = self.index[name]
+        samples = int(entry['Samples'])
+        channels = int(entry['Channels'])
+
+        data = np.fromfile(
+            self.data_path,
+            dtype=np.float32,
+            count=samples*channels,
+            offset=int(entry['Offset']),
+            )
+        if channels > 1:
+            data = data.reshape(samples, channels)
+
+        return int(entry['fs']), data
@@ -6,15 +6,106 @@ Created on Wed Dec 15 15:53:47 2021
 """
 
 import argparse
+import concurrent.futures
+import csv
 import json
 import os
+import re
 
 import plotly.graph_objects as go
 import numpy as np
 import pandas as pd
 import plotly.express as px
+import scipy.stats
 
-from itertools import cycle
+from .volume_adjust_reprocess import reprocessed_csv
+
+
+def _bootstrap_opt(fsf, start, count, volumes, se2, z, resamples, seed):
+    """
+    Compute bootstrap replicates of the optimal volume.
+
+    Trials are resampled with replacement within each volume using a single
+    draw matrix. For each replicate the optimal interval is the range of
+    volumes whose mean FSF is not significantly below the best volume and the
+    optimum is 4/5 of the way through the interval, as in measure.get_opt.
+
+    Parameters
+    ----------
+    fsf : numpy array
+        FSF scores sorted by volume.
+    start : numpy array
+        Index of the first trial of each volume in fsf.
+    count : numpy array
+        Number of trials for each volume.
+    volumes : numpy array
+        Sorted unique volumes.
+    se2 : numpy array
+        Squared standard error of the mean FSF of each volume.
+    z : float
+        Critical value for comparing volume means.
+    resamples : int
+        Number of bootstrap replicates.
+    seed : int or numpy.random.SeedSequence
+        Seed for the random number generator.
+
+    Returns
+    -------
+    numpy array
+        Optimal volume for each replicate.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Volume index of each trial
+    vol_idx = np.repeat(np.arange(len(count)), count)
+    # Draw trials within each volume, one row per replicate
+    draws = start[vol_idx] + np.floor(
+        rng.random((resamples, len(fsf))) * count[vol_idx]
+        ).astype(int)
+    # Mean FSF of each volume for each replicate
+    means = np.add.reduceat(fsf[draws], start, axis=1) / count
+
+    lo, hi = _opt_interval(means, volumes, se2, z)
+
+    return lo + (hi - lo)*(4/5)
+
+
+def _opt_interval(means, volumes, se2, z):
+    """
+    Find the optimal interval from volume means.
+
+    The interval is the range of volumes whose mean FSF is not significantly
+    below the best volume.
+
+    Parameters
+    ----------
+    means : numpy array
+        Mean FSF of each volume, one row for each set of means.
+    volumes : numpy array
+        Volumes, in dB, of each column of means.
+    se2 : numpy array
+        Squared standard error of the mean FSF of each volume.
+    z : float
+        Critical value for comparing volume means.
+
+    Returns
+    -------
+    lo : numpy array
+        Lower bound of the interval for each row.
+    hi : numpy array
+        Upper bound of the interval for each row.
+    """
+    # Best volume of each row
+    best = np.argmax(means, axis=1)
+    best_mean = means[np.arange(len(means)), best]
+    # Volumes not significantly below the best
+    margin = z * np.sqrt(se2 + se2[best][:, np.newaxis])
+    in_group = means >= (best_mean[:, np.newaxis] - margin)
+
+    lo = np.min(np.where(in_group, volumes, np.inf), axis=1)
+    hi = np.max(np.where(in_group, volumes, -np.inf), axis=1)
+
+    return lo, hi
 
 
 # Main class for evaluating
@@ -93,9 +184,77 @@ class evaluate():
                 dat_file = test_name
     
             full_path = dat_file
+
+            # Use reprocessed data if it exists
+            if use_reprocess and os.path.exists(reprocessed_csv(dat_file)):
+                full_path = reprocessed_csv(dat_file)
     
             self.optimal, self.data = evaluate.load_data(full_path)    
 
+    def eval(self, resamples=10000, alpha=0.05, processes=None, chunk_size=1000, seed=None):
+        """
+        Determine the TVO of a test with a bootstrap confidence interval.
+
+        Trials are resampled within each volume. For each resample the optimal
+        interval is the range of volumes whose mean FSF is not significantly
+        lower than the best volume, and the optimum is 4/5 of the way through
+        that interval, matching measure.get_opt.
+
+        Parameters
+        ----------
+        resamples : int, optional
+            Number of bootstrap resamples. The default is 10000.
+        alpha : float, optional
+            Significance level for the confidence interval and for comparing
+            volume means. The default is 0.05.
+        processes : int, optional
+            If given, compute resamples in this many worker processes. The
+            default is None, compute in this process.
+        chunk_size : int, optional
+            Maximum number of resamples drawn at once, limits memory use. The
+            default is 1000.
+        seed : int, optional
+            Seed for the random number generator. The default is None.
+
+        Returns
+        -------
+        mean : float
+            Mean optimal volume across resamples.
+        ci : numpy array
+            Lower and upper confidence bound on the optimal volume.
+        """
+        df = self.data.dropna(subset=['Volume', 'FSF'])
+        vols = df['Volume'].to_numpy(dtype=float)
+        order = np.argsort(vols, kind='stable')
+        fsf = df['FSF'].to_numpy(dtype=float)[order]
+        volumes, start, count = np.unique(vols[order], return_index=True, return_counts=True)
+
+        # Squared standard error of each volume mean
+        se2 = np.add.reduceat(np.square(fsf - np.repeat(
+            np.add.reduceat(fsf, start) / count, count)), start) / count / count
+        z = scipy.stats.norm.ppf(1 - alpha/2)
+
+        # Split resamples into chunks, each with its own seed
+        chunks = [chunk_size]*(resamples // chunk_size)
+        if resamples % chunk_size:
+            chunks.append(resamples % chunk_size)
+        seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+        args = (fsf, start, count, volumes, se2, z)
+
+        if processes is None:
+            opts = [_bootstrap_opt(*args, n, sd) for n, sd in zip(chunks, seeds)]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+                futures = [executor.submit(_bootstrap_opt, *args, n, sd)
+                           for n, sd in zip(chunks, seeds)]
+                opts = [f.result() for f in futures]
+        opts = np.concatenate(opts)
+
+        self.mean = np.mean(opts)
+        self.ci = np.quantile(opts, [alpha/2, 1 - alpha/2])
+
+        return self.mean, self.ci
+
     @staticmethod    
     def load_data(filepath):
         """
@@ -158,23 +317,86 @@ class evaluate():
         
         return optimum_intervals
         
+    @staticmethod
+    def _frame_from_json(frame):
+        """Create DataFrame from split orient dict or legacy json string."""
+        if isinstance(frame, str):
+            # Legacy format, DataFrame was encoded as a json string
+            return pd.read_json(frame)
+        return pd.DataFrame(frame['data'], columns=frame['columns'])
+
     @staticmethod
     def load_json_data(json_data):
+        """
+        Load TVO data from its json representation.
+
+        Both the split orient format written by to_json and the legacy format,
+        where each DataFrame is a nested json string, are supported.
+
+        Parameters
+        ----------
+        json_data : str or dict
+            json string or parsed json of a single TVO test.
+
+        Returns
+        -------
+        filename : set of str
+            Test name.
+        optimum : pd.DataFrame
+            Optimum and interval data.
+        data : pd.DataFrame
+            Volumes and FSF scores from the TVO measurement.
+        """
         if isinstance(json_data, str):
             json_data = json.loads(json_data)
             
         # Extract data, cps, and test_info from json_data
-        data = pd.read_json(json_data['measurement'])
-        optimum = pd.read_json(json_data['optimal'])
+        data = evaluate._frame_from_json(json_data['measurement'])
+        optimum = evaluate._frame_from_json(json_data['optimal'])
         
         filename = set(json_data['test_info'].keys())
         
         return filename, optimum, data
-        
+
+    @staticmethod
+    def load_json_collection(json_data):
+        """
+        Load several TVO tests from a json collection.
+
+        Parameters
+        ----------
+        json_data : str or dict
+            json string, or parsed json, as written by collection_to_json.
+
+        Returns
+        -------
+        list of evaluate
+            One evaluate object for each test in the collection.
+        """
+        if isinstance(json_data, str):
+            json_data = json.loads(json_data)
+
+        return [evaluate(json_data=t) for t in json_data['tests']]
+
+    def _json_str(self):
+        """Return json string for this test, DataFrames are encoded once."""
+        if isinstance(self.test_name, set):
+            test_info = dict.fromkeys(self.test_name)
+        else:
+            test_info = {self.test_name: None}
+
+        # Embed split orient DataFrames directly rather than as json strings
+        return ('{"measurement": ' + self.data.to_json(orient='split', index=False) +
+                ', "optimal": ' + self.optimal.to_json(orient='split', index=False) +
+                ', "test_info": ' + json.dumps(test_info) + '}')
+
     def to_json(self, filename=None):
         """
         Create json representation of TVO data
 
+        DataFrames are stored in pandas split orient, column names once and
+        then rows of values.
+
         Parameters
         ----------
         filename : str, optional
@@ -182,76 +404,130 @@ class evaluate():
 
         Returns
         -------
-        None
+        final_json : str
+            json representation of the test.
         """
         
-        test_info = {self.test_name: None}
-        out_json = {
-            'measurement': self.data.to_json(),
-            'optimal': self.optimal.to_json(),
-            'test_info': test_info,
-                }
-        
         # Final json representation of all data
-        final_json = json.dumps(out_json)
+        final_json = self._json_str()
         if filename is not None:
             with open(filename, 'w') as f:
-                json.dump(out_json, f)
+                f.write(final_json)
         
         return final_json
+
+    @staticmethod
+    def collection_to_json(evals, filename=None):
+        """
+        Create a single json representation of several TVO tests.
+
+        Parameters
+        ----------
+        evals : list of evaluate
+            Tests to include.
+        filename : str, optional
+            If given save to json file. The default is None.
+
+        Returns
+        -------
+        final_json : str
+            json representation of all tests, can be loaded with
+            load_json_collection.
+        """
+        final_json = '{"tests": [' + ', '.join(e._json_str() for e in evals) + ']}'
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(final_json)
+
+        return final_json
         
     def plot(self, talkers=None, x=None,
              color_palette=px.colors.qualitative.Plotly,
-             title='Scatter plot of FSF scores'):
+             title='Scatter plot of FSF scores',
+             max_points=None, webgl_threshold=1000):
+        """
+        Plot FSF scores.
+
+        Parameters
+        ----------
+        talkers : str or list of str, optional
+            Only plot data for these clips. The default is None.
+        x : str, optional
+            Column to use for the x-axis. If 'Volume', the average FSF, volume
+            order and optimal interval are added to the plot. The default is
+            None.
+        color_palette : list, optional
+            Colors to use. The default is px.colors.qualitative.Plotly.
+        title : str, optional
+            Plot title. The default is 'Scatter plot of FSF scores'.
+        max_points : int, optional
+            If given, plot a random subset of at most max_points trials.
+            Averages are always computed from all trials. The default is None.
+        webgl_threshold : int, optional
+            Use WebGL rendering when more than this many points are plotted.
+            The default is 1000.
+
+        Returns
+        -------
+        plotly.graph_objects.Figure
+        """
         
         df = self.data
         
-        # Filter by talkers if given
         # Filter by talkers if given
         if talkers is not None:
-            df_filt = []
             if isinstance(talkers, str):
                 talkers = [talkers]
-            for talker in talkers:
-                df_filt.append(df[df['Filename'] == talker])
-            df = pd.concat(df_filt)
-            
-
-        fig = px.scatter(df, x=x, y='FSF',
+            df = df[df['Filename'].isin(talkers)]
+        
+        # Downsample points for the scatter plot
+        if max_points is not None and len(df) > max_points:
+            df_plot = df.sample(n=max_points, random_state=0).sort_index()
+        else:
+            df_plot = df
+        
+        webgl = len(df_plot) > webgl_threshold
+        
+        fig = px.scatter(df_plot, x=x, y='FSF',
                          color='Filename',
                          title=title,
                          color_discrete_sequence=color_palette,
+                         render_mode='webgl' if webgl else 'svg',
                           )
         if x == 'Volume':
-            palette = cycle(color_palette)
-            for _ in set(df['Filename']):
-                avg_color = next(palette)
-            avg_color = next(palette)
+            # Average gets the next color after the clips
+            avg_color = color_palette[df['Filename'].nunique() % len(color_palette)]
+            
+            # Compute mean, first trial and trial count for each volume at once
+            vol_stats = (df.assign(trial=np.arange(len(df)))
+                         .groupby('Volume', as_index=False)
+                         .agg(FSF=('FSF', 'mean'),
+                              first=('trial', 'min'),
+                              count=('trial', 'size'))
+                         )
+            scatter = go.Scattergl if webgl else go.Scatter
+            
             # Plot average volumes
-            vol_means = df.groupby('Volume', as_index=False)['FSF'].mean()
             fig.add_trace(
-                go.Scatter(x=vol_means['Volume'],
-                           y=vol_means['FSF'],
-                           name='Average FSF',
-                           line={'color': avg_color},
+                scatter(x=vol_stats['Volume'],
+                        y=vol_stats['FSF'],
+                        name='Average FSF',
+                        line={'color': avg_color},
+                        )
+                )
+            
+            # Label volume order with a single text trace
+            vol_order = vol_stats['first'] // vol_stats['count'] + 1
+            fig.add_trace(
+                go.Scatter(x=vol_stats['Volume'],
+                           y=vol_stats['FSF'],
+                           text=['Order:<br>' + str(o) for o in vol_order],
+                           mode='text',
+                           textposition='top center',
+                           name='Volume order',
                            )
                 )
             
-            # Label volume order
-            vol_ixs = df.groupby('Volume').indices
-            for vol, ix in vol_ixs.items():
-                ix_order = int(np.floor(ix[0]/ len(ix)) + 1)
-                # import pdb; pdb.set_trace()
-                vfsf = vol_means[vol_means['Volume'] == vol].iloc[0]['FSF']
-                vtext = f'Order:\n{ix_order}'
-                # vtext = ix_order
-
-                fig.add_annotation(
-                    x=vol,
-                    y=vfsf,
-                    text=vtext,
-                    showarrow=True,
-                    )
             # Plot interval
             delta = 0.1
             dmax = df['FSF'].values.max() + delta
@@ -273,6 +549,276 @@ class evaluate():
         return fig
 
 
+class evaluate_live(evaluate):
+    """
+    Evaluate a TVO session while it is running.
+
+    Rows are read incrementally from the temporary csv that measure.run
+    writes during a session. Only data added since the last update is read.
+    Per-volume statistics and the current optimal interval are updated from
+    the new rows, and plots can be refreshed in place.
+
+    measure.run writes the temporary csv once for each volume step, so new
+    rows arrive a whole step at a time rather than after every trial.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the temporary csv, or to the session folder.
+    alpha : float, optional
+        Significance level used to find the current interval. The default is
+        0.05.
+
+    Attributes
+    ----------
+    data : pd.DataFrame
+        All rows read so far.
+    optimal : pd.DataFrame
+        Current optimum and interval estimate.
+    finished : bool
+        True once the session has ended and the temporary csv was removed.
+    """
+
+    # Columns that are stored as numbers
+    numeric_fields = ('Volume', 'FSF', 'm2e_latency')
+
+    def __init__(self, filename, alpha=0.05):
+        if os.path.isdir(filename):
+            name = os.path.basename(os.path.normpath(filename))
+            filename = os.path.join(filename, name + '_TEMP.csv')
+        self.filename = filename
+        self.test_name = re.sub(r'_TEMP\.csv$', '', os.path.basename(filename))
+        self.z = scipy.stats.norm.ppf(1 - alpha/2)
+        self.finished = False
+
+        # Read position and incomplete last line
+        self._offset = 0
+        self._partial = b''
+        self._header = None
+        self._columns = {}
+        self._frame = None
+        # Count, sum, sum of squares and first row of each volume
+        self._stats = {}
+        # Live figure, its settings and the number of rows plotted in it
+        self._fig = None
+        self._scatter = None
+        self._talkers = None
+        self._plotted = 0
+        self._fsf_range = [np.inf, -np.inf]
+
+    def update(self):
+        """
+        Read rows added to the temporary csv since the last update.
+
+        Returns
+        -------
+        int
+            Number of new rows.
+        """
+        try:
+            with open(self.filename, 'rb') as f:
+                f.seek(self._offset)
+                chunk = f.read()
+                self._offset = f.tell()
+        except FileNotFoundError:
+            # Temporary csv is removed when the session finishes
+            if self._header is not None:
+                self.finished = True
+            return 0
+
+        lines = (self._partial + chunk).split(b'\n')
+        # Last line is incomplete until a newline is written
+        self._partial = lines.pop()
+
+        rows = list(csv.reader(line.decode() for line in lines if line))
+        if self._header is None and rows:
+            self._header = rows.pop(0)
+            self._columns = {h: [] for h in self._header}
+
+        vol_col = self._columns.get('Volume', [])
+        fsf_col = self._columns.get('FSF', [])
+        for row in rows:
+            n = len(fsf_col)
+            for h, val in zip(self._header, row):
+                self._columns[h].append(float(val) if h in self.numeric_fields else val)
+
+            vol, fsf = vol_col[-1], fsf_col[-1]
+            st = self._stats.setdefault(vol, [0, 0.0, 0.0, n])
+            st[0] += 1
+            st[1] += fsf
+            st[2] += fsf*fsf
+
+        if rows:
+            self._frame = None
+
+        return len(rows)
+
+    @property
+    def data(self):
+        """All rows read so far as a DataFrame."""
+        if self._frame is None:
+            self._frame = pd.DataFrame(self._columns)
+            self._frame['name'] = self.test_name
+        return self._frame
+
+    def volume_stats(self):
+        """
+        Get per-volume statistics.
+
+        Returns
+        -------
+        pd.DataFrame
+            Volume, mean FSF, trial count and first row of each volume,
+            sorted by volume.
+        """
+        vols = sorted(self._stats)
+        st = np.array([self._stats[v] for v in vols], dtype=float).reshape(-1, 4)
+        return pd.DataFrame({
+            'Volume': vols,
+            'FSF': st[:, 1] / st[:, 0],
+            'count': st[:, 0].astype(int),
+            'first': st[:, 3].astype(int),
+            })
+
+    @property
+    def optimal(self):
+        """Current optimum and interval estimate as a DataFrame."""
+        cols = ['Optimum [dB]', 'Lower_Interval [dB]', 'Upper_Interval [dB]']
+        if not self._stats:
+            return pd.DataFrame([[np.nan]*3], columns=cols)
+
+        vols = np.array(sorted(self._stats))
+        st = np.array([self._stats[v] for v in vols])
+        means = st[:, 1] / st[:, 0]
+        # Squared standard error of each volume mean
+        var = np.maximum(st[:, 2] / st[:, 0] - means**2, 0)
+        lo, hi = _opt_interval(means[np.newaxis, :], vols, var / st[:, 0], self.z)
+
+        return pd.DataFrame([[lo[0] + (hi[0] - lo[0])*(4/5), lo[0], hi[0]]], columns=cols)
+
+    def refresh(self, fig=None, talkers=None,
+                color_palette=px.colors.qualitative.Plotly,
+                title='Scatter plot of FSF scores', render_mode='webgl'):
+        """
+        Read new rows and update a plot of FSF against volume in place.
+
+        Only rows added since the last refresh are added to the clip traces.
+        The average, volume order and interval traces are set from the
+        per-volume statistics. A figure that was not made by the last call
+        to refresh, or a change of talkers, clears the figure and it is
+        redrawn from the start.
+
+        Parameters
+        ----------
+        fig : plotly.graph_objects.FigureWidget or Figure, optional
+            Figure to update. If None a new FigureWidget is created, or a
+            Figure if FigureWidget can not be used because anywidget is not
+            installed.
+        talkers : str or list of str, optional
+            Only plot trials of these clips. Averages and the interval always
+            use all clips. The default is None.
+        color_palette : list, optional
+            Colors to use. The default is px.colors.qualitative.Plotly.
+        title : str, optional
+            Plot title. The default is 'Scatter plot of FSF scores'.
+        render_mode : str, optional
+            'webgl' or 'svg'. The mode is set when the figure is created and
+            kept as the figure grows. The default is 'webgl'.
+
+        Returns
+        -------
+        plotly.graph_objects.FigureWidget or Figure
+            Updated figure.
+        """
+        self.update()
+
+        if isinstance(talkers, str):
+            talkers = [talkers]
+
+        if fig is None:
+            try:
+                fig = go.FigureWidget()
+            except ImportError:
+                # FigureWidget needs anywidget, a Figure can still be shown
+                # again after each refresh
+                fig = go.Figure()
+        if fig is not self._fig or talkers != self._talkers:
+            # Start a new live figure
+            fig.data = ()
+            fig.update_layout(title=title, xaxis_title='Volume', yaxis_title='FSF')
+            self._fig = fig
+            self._scatter = go.Scattergl if render_mode == 'webgl' else go.Scatter
+            self._talkers = talkers
+            self._plotted = 0
+            self._fsf_range = [np.inf, -np.inf]
+
+        if not self._stats:
+            # Nothing to plot yet
+            return fig
+
+        # Group new rows by clip
+        n = len(self._columns['FSF'])
+        new_rows = {}
+        for name, vol, fsf in zip(self._columns['Filename'][self._plotted:n],
+                                  self._columns['Volume'][self._plotted:n],
+                                  self._columns['FSF'][self._plotted:n]):
+            self._fsf_range = [min(self._fsf_range[0], fsf), max(self._fsf_range[1], fsf)]
+            if talkers is None or name in talkers:
+                xy = new_rows.setdefault(name, ([], []))
+                xy[0].append(vol)
+                xy[1].append(fsf)
+        self._plotted = n
+
+        vol_stats = self.volume_stats()
+        vol_order = vol_stats['first'] // vol_stats['count'] + 1
+        optimal = self.optimal
+        delta = 0.1
+        dmin, dmax = self._fsf_range[0] - delta, self._fsf_range[1] + delta
+        line_types = ['dash', 'dot', 'dot']
+
+        with fig.batch_update():
+            traces = {t.name: t for t in fig.data}
+            summary = ['Average FSF', 'Volume order'] + list(optimal.columns)
+            clips = [t for t in traces if t not in summary]
+
+            for name, (xs, ys) in new_rows.items():
+                if name in traces:
+                    trace = traces[name]
+                    trace.x = tuple(trace.x) + tuple(xs)
+                    trace.y = tuple(trace.y) + tuple(ys)
+                else:
+                    color = color_palette[len(clips) % len(color_palette)]
+                    fig.add_trace(self._scatter(x=xs, y=ys, mode='markers', name=name,
+                                                marker={'color': color}))
+                    clips.append(name)
+
+            # Average gets the next color after the clips
+            avg_color = color_palette[len(clips) % len(color_palette)]
+            summary_traces = [
+                self._scatter(x=vol_stats['Volume'], y=vol_stats['FSF'],
+                              name='Average FSF', line={'color': avg_color}),
+                go.Scatter(x=vol_stats['Volume'], y=vol_stats['FSF'],
+                           text=['Order:<br>' + str(o) for o in vol_order],
+                           mode='text', textposition='top center',
+                           name='Volume order'),
+                ]
+            for key, ddash in zip(optimal.columns, line_types):
+                val = optimal.loc[0, key]
+                summary_traces.append(
+                    go.Scatter(x=[val, val], y=[dmin, dmax], mode='lines',
+                               line=dict(color='black', width=3, dash=ddash),
+                               name=key)
+                    )
+
+            for new_trace in summary_traces:
+                if new_trace.name in traces:
+                    traces[new_trace.name].update(new_trace.to_plotly_json())
+                else:
+                    fig.add_trace(new_trace)
+
+        return fig
+
+
 # Main definition
 def main():
     """
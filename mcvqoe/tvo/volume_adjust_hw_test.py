@@ -1,3 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Run TVO measurements from config files.
+
+Each config file is a json file with the measure parameters of one or more
+jobs. A file may contain a single job, a list of jobs or an object with a
+'jobs' list and a 'defaults' object that is applied to every job in the
+file. Along with measure parameters a job may have these keys:
+
+name : str
+    Name used for the job in summaries. Defaults to the file name and job
+    number.
+sim : bool or dict
+    Run with mcvqoe.simulation.QoEsim instead of hardware. A dict gives
+    QoEsim parameters.
+radioport : str
+    Port of the radio interface. Defaults to searching for the interface.
+audio : dict
+    Parameters for mcvqoe.hardware.AudioPlayer.
+
+If a job does not give audio_files the clips included with the package are
+used, read from audio_path or from the package audio folder if audio_path is
+not given either.
+
+Jobs are run in order. Sessions from each job are evaluated and added to
+the result index in background processes while later jobs run.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+
+from .volume_adjust import measure
+from .volume_adjust_eval import evaluate
+from .volume_adjust_reprocess import session_csv
+
+# Name of the result index written in the output folder
+index_name = 'tvo_index.jsonl'
+
+# Job keys that are not measure parameters
+_job_keys = ('name', 'sim', 'radioport', 'audio')
+
+
+def load_jobs(config_names):
+    """
+    Read jobs from config files.
+
+    Parameters
+    ----------
+    config_names : list of str
+        Paths to json config files.
+
+    Returns
+    -------
+    list of dict
+        Jobs, in order. Each job has a 'name' and a 'config' key.
+    """
+    jobs = []
+    for config_name in config_names:
+        with open(config_name, 'r') as f:
+            config = json.load(f)
+
+        if isinstance(config, dict) and 'jobs' in config:
+            defaults = config.get('defaults', {})
+            config_jobs = [{**defaults, **job} for job in config['jobs']]
+        elif isinstance(config, list):
+            config_jobs = config
+        else:
+            config_jobs = [config]
+
+        base = os.path.splitext(os.path.basename(config_name))[0]
+        for n, job in enumerate(config_jobs):
+            job = dict(job)
+            job.setdefault('name', f'{base}_{n+1}')
+            job['config'] = config_name
+            jobs.append(job)
+
+    return jobs
+
+
+def job_measure(job, outdir=''):
+    """
+    Create the measurement object for a job.
+
+    Parameters
+    ----------
+    job : dict
+        Job from load_jobs.
+    outdir : str, optional
+        Output folder used if the job does not set outdir.
+
+    Returns
+    -------
+    measure
+        Measurement object with the job parameters.
+    """
+    params = {k: v for k, v in job.items() if k not in _job_keys + ('config',)}
+    params.setdefault('outdir', outdir)
+    test_obj = measure(**params)
+
+    if 'audio_files' not in params:
+        # Default clips are full paths, audio file names must be relative
+        # to audio_path since they are used in recording names
+        test_obj.audio_files = [os.path.basename(f) for f in test_obj.audio_files]
+        if 'audio_path' not in params:
+            test_obj.audio_path = measure.included_audio_path()
+
+    return test_obj
+
+
+def run_job(job, test_obj):
+    """
+    Run a single measurement job.
+
+    Parameters
+    ----------
+    job : dict
+        Job from load_jobs.
+    test_obj : measure
+        Measurement object from job_measure. Sessions that were done are in
+        test_obj.data_dirs, also if the test raised an exception.
+
+    Returns
+    -------
+    measure
+        Measurement object after the test has run.
+    """
+    if job.get('sim'):
+        import mcvqoe.simulation
+
+        sim_params = job['sim'] if isinstance(job['sim'], dict) else {}
+        sim_obj = mcvqoe.simulation.QoEsim(**sim_params)
+        test_obj.ri = sim_obj
+        test_obj.audio_interface = sim_obj
+        test_obj.param_check()
+        test_obj.run()
+    else:
+        import mcvqoe.hardware
+
+        test_obj.audio_interface = mcvqoe.hardware.AudioPlayer(**job.get('audio', {}))
+        with mcvqoe.hardware.RadioInterface(job.get('radioport', '')) as ri:
+            test_obj.ri = ri
+            test_obj.param_check()
+            test_obj.run()
+
+    return test_obj
+
+
+def post_process(session_dir, resamples=10000):
+    """
+    Evaluate a session.
+
+    Parameters
+    ----------
+    session_dir : str
+        Session folder.
+    resamples : int, optional
+        Number of bootstrap resamples. Defaults to 10000.
+
+    Returns
+    -------
+    dict
+        Session results for the index.
+    """
+    eval_obj = evaluate(session_csv(session_dir))
+    mean, ci = eval_obj.eval(resamples=resamples)
+    opt = eval_obj.optimal.iloc[0]
+
+    return {
+        'session': session_dir,
+        'opt': float(opt['Optimum [dB]']),
+        'lim': [float(opt['Lower_Interval [dB]']), float(opt['Upper_Interval [dB]'])],
+        'eval_mean': float(mean),
+        'eval_ci': [float(c) for c in ci],
+        'trials': len(eval_obj.data),
+        }
+
+
+def _index_result(summary, future, index_path):
+    """Add a finished post-processing result to the summary and index."""
+    try:
+        result = future.result()
+    except Exception as e:
+        summary['post_errors'].append(f'{type(e).__name__}: {e}')
+        return
+
+    result['job'] = summary['name']
+    summary['sessions'].append(result)
+    with open(index_path, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+
+def run_queue(jobs, outdir='', workers=None, resamples=10000):
+    """
+    Run jobs in order, evaluating sessions in the background.
+
+    A job that fails is recorded in its summary and the next job is run.
+
+    Parameters
+    ----------
+    jobs : list of dict
+        Jobs from load_jobs.
+    outdir : str, optional
+        Output folder for jobs that do not set outdir. The result index is
+        written here.
+    workers : int, optional
+        Number of post-processing processes. Defaults to the number of CPUs.
+    resamples : int, optional
+        Number of bootstrap resamples for evaluation. Defaults to 10000.
+
+    Returns
+    -------
+    list of dict
+        Summary of each job.
+    """
+    summaries = []
+    pending = []
+
+    if outdir:
+        os.makedirs(outdir, exist_ok=True)
+    index_path = os.path.join(outdir, index_name)
+
+    def index_done(wait=False):
+        # Index sessions that finished post-processing
+        for summary, future in list(pending):
+            if wait or future.done():
+                _index_result(summary, future, index_path)
+                pending.remove((summary, future))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for job in jobs:
+            summary = {
+                'name': job['name'],
+                'config': job['config'],
+                'status': 'ok',
+                'error': None,
+                'start': datetime.datetime.now().isoformat(),
+                'sessions': [],
+                'post_errors': [],
+                }
+            summaries.append(summary)
+
+            test_obj = None
+            try:
+                test_obj = job_measure(job, outdir=outdir)
+                run_job(job, test_obj)
+            except Exception as e:
+                summary['status'] = 'error'
+                summary['error'] = f'{type(e).__name__}: {e}'
+            summary['end'] = datetime.datetime.now().isoformat()
+
+            # Evaluate finished sessions while the next job runs, sessions
+            # done before an error are also evaluated
+            if test_obj is not None:
+                for session_dir in test_obj.data_dirs:
+                    if os.path.exists(session_csv(session_dir)):
+                        pending.append((summary, executor.submit(post_process, session_dir, resamples)))
+
+            index_done()
+
+        index_done(wait=True)
+
+    return summaries
+
+
+# Main definition
 def main():
-    
-    print(f"Hello World")
\ No newline at end of file
+    """
+    Run TVO jobs with command line arguments.
+
+    Returns
+    -------
+    list of dict
+        Summary of each job.
+
+    """
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('configs',
+                        type=str,
+                        nargs="+",
+                        action="extend",
+                        help="json config files with jobs to run.")
+    parser.add_argument('-o', '--outdir',
+                        default='',
+                        type=str,
+                        help=("Output folder for jobs that do not set one. The "
+                              "result index is written here."))
+    parser.add_argument('-s', '--summary',
+                        default=None,
+                        type=str,
+                        help=("File to write the json summary to. Defaults to "
+                              "printing it when all jobs are done."))
+    parser.add_argument('-j', '--jobs',
+                        default=None,
+                        type=int,
+                        help="Number of post-processing processes to use.")
+    parser.add_argument('-r', '--resamples',
+                        default=10000,
+                        type=int,
+                        help="Number of bootstrap resamples for evaluation.")
+
+    args = parser.parse_args()
+
+    summaries = run_queue(load_jobs(args.configs), outdir=args.outdir,
+                          workers=args.jobs, resamples=args.resamples)
+
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summaries, f, indent=1)
+    else:
+        print(json.dumps(summaries, indent=1))
+
+    return summaries
+
+
+if __name__ == "__main__":
+    main()
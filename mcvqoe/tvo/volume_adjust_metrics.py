@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Local metrics exporter for TVO.
+
+Progress of a running TVO session is served over HTTP in the Prometheus
+text format so that many test stations can be watched from one place.
+"""
+
+import collections
+import http.server
+import math
+import threading
+import time
+
+# Window, in seconds, used for the trial rate
+rate_window = 300
+
+
+class session_metrics:
+    """
+    Thread safe progress metrics of a TVO session.
+
+    Parameters
+    ----------
+    station : str, optional
+        Label added to every metric to tell stations apart. Defaults to ''.
+
+    Attributes
+    ----------
+    gauges : dict
+        Current value of each gauge.
+    errors : dict
+        Count of each error type.
+    """
+
+    def __init__(self, station=''):
+        self.station = station
+        self.lock = threading.Lock()
+        self.trials = 0
+        self.gauges = {}
+        self.errors = collections.Counter()
+        self._trial_times = collections.deque()
+        self._step_times = []
+
+    def trial_done(self):
+        """Count a finished trial."""
+        now = time.monotonic()
+        with self.lock:
+            self.trials += 1
+            self._trial_times.append(now)
+            while self._trial_times and now - self._trial_times[0] > rate_window:
+                self._trial_times.popleft()
+
+    def step_done(self, duration):
+        """Add the duration, in seconds, of a measured volume step."""
+        with self.lock:
+            self._step_times.append(duration)
+
+    def error(self, kind):
+        """Count an error of type kind."""
+        with self.lock:
+            self.errors[kind] += 1
+
+    def set(self, **gauges):
+        """Set gauge values."""
+        with self.lock:
+            self.gauges.update(gauges)
+
+    def trial_rate(self):
+        """Return trials per minute over the last rate_window seconds."""
+        now = time.monotonic()
+        with self.lock:
+            # A stalled station has no recent trials
+            times = [t for t in self._trial_times if now - t <= rate_window]
+        if len(times) < 2:
+            return 0.0
+        span = now - times[0]
+        return 60 * (len(times) - 1) / span if span > 0 else 0.0
+
+    def mean_step_time(self):
+        """Return the mean duration of measured steps, NaN if none."""
+        with self.lock:
+            if not self._step_times:
+                return math.nan
+            return sum(self._step_times) / len(self._step_times)
+
+    def render(self):
+        """
+        Format metrics in the Prometheus text format.
+
+        Returns
+        -------
+        str
+            Metrics text.
+        """
+        label = f'station="{self.station}"'
+        rate = self.trial_rate()
+        with self.lock:
+            gauges = dict(self.gauges)
+            trials = self.trials
+            errors = dict(self.errors)
+
+        remaining = gauges.get('steps_remaining', math.nan)
+        gauges['trials_per_minute'] = rate
+        gauges['eta_seconds'] = remaining * self.mean_step_time()
+
+        lines = [
+            '# TYPE tvo_trials_total counter',
+            f'tvo_trials_total{{{label}}} {trials}',
+            '# TYPE tvo_errors_total counter',
+            ]
+        for kind, count in sorted(errors.items()):
+            lines.append(f'tvo_errors_total{{{label},type="{kind}"}} {count}')
+        for name, value in sorted(gauges.items()):
+            lines.append(f'# TYPE tvo_{name} gauge')
+            lines.append(f'tvo_{name}{{{label}}} {float(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class _metrics_handler(http.server.BaseHTTPRequestHandler):
+    """Serve metrics of the server's session_metrics."""
+
+    def do_GET(self):
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't print a line for every scrape
+        pass
+
+
+class metrics_server:
+    """
+    HTTP server for session metrics in a daemon thread.
+
+    Parameters
+    ----------
+    metrics : session_metrics
+        Metrics to serve.
+    port : int
+        Port to listen on.
+    host : str, optional
+        Address to listen on. Defaults to '127.0.0.1', local only.
+    """
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        self.metrics = metrics
+        self.httpd = http.server.ThreadingHTTPServer((host, port), _metrics_handler)
+        self.httpd.daemon_threads = True
+        self.httpd.metrics = metrics
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop_serving(self):
+        """Stop the server."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Session profiler for TVO.
+
+Blocking steps of a TVO session are timed by processing phase, and the
+session can also be run under cProfile. The phase summary and profile are
+saved in the session folder so slow test setups can be looked at after the
+fact.
+"""
+
+import cProfile
+import io
+import pstats
+import time
+
+# Processing phase of each step function, other steps are counted as 'other'
+phase_names = {
+    'load_audio': 'load_audio',
+    'score': 'scoring',
+    'rx_diagnostics': 'scoring',
+    'get_next': 'optimizer',
+    'play_record': 'play/record',
+    'wait': 'PTT wait',
+    'audio_read': 'I/O',
+    'audio_write': 'I/O',
+    'append': 'I/O',
+    'append_temp': 'I/O',
+    'write_trials': 'I/O',
+    'drain_compress': 'compression wait',
+    }
+
+
+class session_profiler:
+    """
+    Time the steps of a session by phase and optionally run cProfile.
+
+    Parameters
+    ----------
+    cprofile : bool, optional
+        Run cProfile while the profiler is started. Defaults to True.
+    top : int, optional
+        Number of functions listed from the cProfile output in the summary.
+        Defaults to 30.
+
+    Attributes
+    ----------
+    phases : dict
+        Number of calls and total time, in seconds, of each phase.
+    """
+
+    def __init__(self, cprofile=True, top=30):
+        self.cprofile = cprofile
+        self.top = top
+        self.phases = {}
+        self.running = False
+        self._profile = None
+        self._start = 0.0
+        self.elapsed = 0.0
+
+    def start(self):
+        """Clear phase times and start profiling."""
+        self.phases = {}
+        self.elapsed = 0.0
+        if self.cprofile:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._start = time.perf_counter()
+        self.running = True
+
+    def stop(self):
+        """Stop profiling."""
+        if not self.running:
+            return
+        self.elapsed = time.perf_counter() - self._start
+        if self._profile is not None:
+            self._profile.disable()
+        self.running = False
+
+    def add(self, name, seconds):
+        """
+        Add the time of a step.
+
+        Parameters
+        ----------
+        name : str
+            Name of the step function, or 'wait' for a pause.
+        seconds : float
+            Time the step took.
+        """
+        if not self.running:
+            return
+        phase = self.phases.setdefault(phase_names.get(name, 'other'), [0, 0.0])
+        phase[0] += 1
+        phase[1] += seconds
+
+    def summary(self):
+        """
+        Return a text table of phase times followed by cProfile results.
+
+        Returns
+        -------
+        str
+            Profile summary.
+        """
+        total = self.elapsed
+        lines = [f"{'Phase':<20}{'Calls':>8}{'Total [s]':>12}{'Mean [s]':>12}{'Percent':>10}"]
+        tracked = 0.0
+        for name, (calls, secs) in sorted(self.phases.items(), key=lambda p: -p[1][1]):
+            tracked += secs
+            lines.append(f"{name:<20}{calls:>8}{secs:>12.3f}{secs/calls:>12.4f}"
+                         f"{100*secs/total if total else 0:>10.1f}")
+        untracked = max(total - tracked, 0)
+        lines.append(f"{'untracked':<20}{'':>8}{untracked:>12.3f}{'':>12}"
+                     f"{100*untracked/total if total else 0:>10.1f}")
+        lines.append(f"{'session':<20}{'':>8}{total:>12.3f}")
+
+        if self._profile is not None:
+            out = io.StringIO()
+            stats = pstats.Stats(self._profile, stream=out)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            lines.extend(['', out.getvalue()])
+
+        return '\n'.join(lines) + '\n'
+
+    def save(self, prefix):
+        """
+        Save the summary and cProfile output.
+
+        Parameters
+        ----------
+        prefix : str
+            Path and base name of the files. The summary is written to
+            prefix + '_profile.txt' and cProfile output to
+            prefix + '_profile.prof'.
+
+        Returns
+        -------
+        str
+            Path to the summary.
+        """
+        self.stop()
+        if self._profile is not None:
+            self._profile.dump_stats(prefix + '_profile.prof')
+        summary_name = prefix + '_profile.txt'
+        with open(summary_name, 'w') as f:
+            f.write(self.summary())
+        return summary_name
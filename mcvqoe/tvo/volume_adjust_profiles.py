@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Device profile store for TVO.
+
+Results of previous TVO sessions are stored by test setup so that later
+sessions on the same setup can start from a narrower volume interval.
+"""
+
+import datetime
+import json
+import os
+
+import numpy as np
+
+
+class device_profiles:
+    """
+    Store of past TVO results keyed by test setup.
+
+    Results are stored in a json file. The key for a setup is made from the
+    Tx and Rx device in the test info, the names of the audio files and the
+    sample rate. Setups without a Tx and Rx device in the test info have no
+    key and are not stored.
+
+    Parameters
+    ----------
+    path : str, optional
+        Path to the profile file. Defaults to 'tvo_profiles.json' in the
+        '.mcvqoe' folder in the users home directory.
+    history : int, optional
+        Number of most recent results used for the prior. Defaults to 10.
+
+    Attributes
+    ----------
+    profiles : dict
+        Results for each setup key.
+    """
+
+    def __init__(self, path=None, history=10):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.mcvqoe', 'tvo_profiles.json')
+        self.path = path
+        self.history = history
+        self.profiles = self._read()
+
+    def _read(self):
+        """Read profiles from the profile file, empty if there is no file."""
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        return {}
+
+    @staticmethod
+    def key(info, audio_files, fs):
+        """
+        Generate the key for a test setup.
+
+        Parameters
+        ----------
+        info : dict
+            Test info, as in measure.info.
+        audio_files : list of str
+            Audio files used in the test.
+        fs : int
+            Sample rate of the test.
+
+        Returns
+        -------
+        str or None
+            Key for the setup, None if the Tx or Rx device is not given.
+        """
+        tx_dev = str(info.get('Tx Device', '')).strip()
+        rx_dev = str(info.get('Rx Device', '')).strip()
+        if not tx_dev or not rx_dev:
+            return None
+
+        clips = sorted(os.path.basename(os.path.splitext(a)[0]) for a in audio_files)
+        return '|'.join([
+            tx_dev,
+            rx_dev,
+            ','.join(clips),
+            str(int(fs)),
+            ])
+
+    def add(self, key, opt, lim):
+        """
+        Add a result for a setup and save the profile file.
+
+        The profile file is read again before writing so results saved by
+        other sessions since this store was loaded are kept.
+
+        Parameters
+        ----------
+        key : str
+            Setup key, see key().
+        opt : float
+            Optimal volume in dB.
+        lim : list of floats
+            Optimal interval in dB.
+        """
+        result = {
+            'opt': float(opt),
+            'lim': [float(lim[0]), float(lim[1])],
+            'time': datetime.datetime.now().isoformat(),
+            }
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Merge with the file as it is now, another session may have written
+        # to it
+        self.profiles = self._read()
+        self.profiles.setdefault(key, []).append(result)
+        # Write to a temporary file first so an interrupted write does not
+        # destroy the store
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.profiles, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def prior(self, key, margin=3.0, bounds=None):
+        """
+        Get the starting interval for a setup from past results.
+
+        The interval spans the optimal intervals of the most recent results
+        with margin added on each side.
+
+        Parameters
+        ----------
+        key : str
+            Setup key, see key().
+        margin : float, optional
+            Margin in dB added on each side. Defaults to 3 dB.
+        bounds : list of floats, optional
+            The interval is limited to bounds if given.
+
+        Returns
+        -------
+        list of floats or None
+            Starting interval, None if there are no results for the setup.
+        """
+        results = self.profiles.get(key, [])[-self.history:]
+        if not results:
+            return None
+
+        lims = np.array([r['lim'] for r in results])
+        lim = [float(np.min(lims[:, 0]) - margin), float(np.max(lims[:, 1]) + margin)]
+
+        if bounds is not None:
+            lim = [max(lim[0], bounds[0]), min(lim[1], bounds[1])]
+            if lim[0] >= lim[1]:
+                return None
+
+        return lim
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Replay recorded TVO data through the volume optimizer.
+
+The optimizer in mcvqoe.tvo.measure is driven with FSF scores drawn from
+previously recorded trials instead of a radio, so that optimizer settings
+can be compared offline.
+"""
+
+import numpy as np
+import pandas as pd
+
+from collections import namedtuple
+
+from .volume_adjust import measure
+from .volume_adjust_eval import evaluate
+
+ReplayResult = namedtuple(
+    'ReplayResult',
+    ['opt', 'lim', 'volumes', 'trials', 'done_step']
+    )
+ReplayResult.__doc__ = """
+Result of an optimizer replay.
+
+Attributes
+----------
+opt : float
+    Optimal volume in dB, NaN if no interval was found.
+lim : list of floats
+    Final optimal interval in dB.
+volumes : list of floats
+    Volumes visited by the optimizer, in order.
+trials : int
+    Number of trials that would have been run on hardware.
+done_step : int or None
+    Volume step where the optimizer first signaled convergence.
+"""
+
+
+def _no_progress(*args, **kwargs):
+    """Progress function that discards all updates."""
+    return True
+
+
+class trial_source:
+    """
+    Draw FSF scores for arbitrary volumes from recorded trials.
+
+    Trials at the requested volume are resampled with replacement. When no
+    trials were recorded at the requested volume, each draw comes from one of
+    the two recorded volumes that bracket it, chosen with probability
+    proportional to proximity. Volumes outside the recorded range use the
+    nearest recorded volume.
+
+    Parameters
+    ----------
+    data : pd.DataFrame, evaluate, str or list of str
+        Recorded trials. Either a DataFrame with 'Volume' and 'FSF' columns,
+        an evaluate object or paths to TVO csv files.
+    rng : numpy.random.Generator, optional
+        Random number generator used for resampling.
+    """
+
+    def __init__(self, data, rng=None):
+        if isinstance(data, evaluate):
+            data = data.data
+        elif isinstance(data, str):
+            data = [data]
+        if isinstance(data, list):
+            data = pd.concat([evaluate.load_data(f)[1] for f in data], ignore_index=True)
+
+        vols = data['Volume'].to_numpy(dtype=float)
+        fsf = data['FSF'].to_numpy(dtype=float)
+
+        # Sort trials by volume so each volume is a contiguous slice
+        order = np.argsort(vols, kind='stable')
+        self.fsf = fsf[order]
+        self.volumes, self.start, self.count = np.unique(
+            vols[order], return_index=True, return_counts=True
+            )
+
+        if rng is None:
+            rng = np.random.default_rng()
+        self.rng = rng
+
+    def draw(self, volume, n):
+        """
+        Draw n FSF scores for volume.
+
+        Parameters
+        ----------
+        volume : float
+            Volume in dB.
+        n : int
+            Number of trials to draw.
+
+        Returns
+        -------
+        numpy array
+            FSF scores.
+        """
+        # Position of volume in recorded volumes
+        hi = np.searchsorted(self.volumes, volume)
+        if hi < len(self.volumes) and np.isclose(self.volumes[hi], volume):
+            src = np.full(n, hi)
+        elif hi == 0:
+            src = np.zeros(n, dtype=int)
+        elif hi == len(self.volumes):
+            src = np.full(n, hi - 1)
+        else:
+            lo = hi - 1
+            # Probability of drawing from the upper volume
+            w = (volume - self.volumes[lo])/(self.volumes[hi] - self.volumes[lo])
+            src = np.where(self.rng.random(n) < w, hi, lo)
+
+        # Random trial within each source volume
+        idx = self.start[src] + np.floor(self.rng.random(n) * self.count[src]).astype(int)
+
+        return self.fsf[idx]
+
+
+def replay(data, lim=(-40.0, 0.0), tol=1.0, ptt_rep=40, smax=30, rng=None):
+    """
+    Run the TVO optimizer on recorded data.
+
+    This follows the volume selection loop in measure.run, including reuse of
+    data for repeated volumes, but draws FSF scores from recorded trials.
+
+    Parameters
+    ----------
+    data : trial_source, pd.DataFrame, evaluate, str or list of str
+        Recorded trials, see trial_source.
+    lim : list of floats, optional
+        Initial volume limits in dB. Defaults to [-40, 0].
+    tol : float, optional
+        Optimizer tolerance in dB. Defaults to 1.
+    ptt_rep : int, optional
+        Number of trials per volume. Defaults to 40.
+    smax : int, optional
+        Maximum number of volumes to sample. Defaults to 30.
+    rng : numpy.random.Generator, optional
+        Random number generator used for resampling and by the optimizer.
+        Defaults to the generator of data. Replays with identically seeded
+        generators produce identical results.
+
+    Returns
+    -------
+    ReplayResult
+        Optimizer result and statistics.
+    """
+    if not isinstance(data, trial_source):
+        data = trial_source(data, rng=rng)
+    if rng is None:
+        rng = data.rng
+
+    opt = measure(lim=list(lim), tol=tol, ptt_rep=ptt_rep, smax=smax,
+                  progress_update=_no_progress, rng=rng)
+
+    volume = []
+    eval_dat = [None for i in range(smax)]
+    trials = 0
+    done_step = None
+
+    for k in range(smax):
+        if k == 0:
+            volume.append(opt.opt_vol_pnt(new_eval=True))
+        else:
+            new_vol, done = opt.get_next(volume[k-1], eval_dat[k-1])
+            volume.append(new_vol)
+            if done and done_step is None:
+                done_step = k
+
+        # Reuse data for repeated volumes
+        idx = next((i for i, v in enumerate(volume[0:k])
+                    if np.absolute(volume[k] - v) < tol), None)
+        if idx is not None:
+            eval_dat[k] = eval_dat[idx]
+            continue
+
+        if np.ma.is_masked(volume[k]):
+            # Grid point masked as a repeat, no new information, but the
+            # trials are still run on hardware
+            eval_dat[k] = eval_dat[k-1]
+        else:
+            eval_dat[k] = data.draw(volume[k], ptt_rep)
+        trials += ptt_rep
+
+    return ReplayResult(
+        opt=opt.get_opt(),
+        lim=list(opt.lim),
+        volumes=[float(np.ma.filled(v, np.nan)) for v in volume],
+        trials=trials,
+        done_step=done_step,
+        )
+
+
+def compare(data, settings, runs=100, lim=(-40.0, 0.0), rng=None):
+    """
+    Compare optimizer settings by repeated replay.
+
+    Parameters
+    ----------
+    data : trial_source, pd.DataFrame, evaluate, str or list of str
+        Recorded trials, see trial_source.
+    settings : list of dict
+        Optimizer settings to compare. Each dict may contain 'tol', 'ptt_rep'
+        and 'smax'.
+    runs : int, optional
+        Number of replays for each setting. Defaults to 100.
+    lim : list of floats, optional
+        Initial volume limits in dB. Defaults to [-40, 0].
+    rng : numpy.random.Generator, optional
+        Random number generator used for resampling.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per setting with the mean and standard deviation of the
+        optimum, mean interval width and mean number of trials.
+    """
+    if not isinstance(data, trial_source):
+        data = trial_source(data, rng=rng)
+
+    rows = []
+    for setting in settings:
+        res = [replay(data, lim=lim, **setting) for _ in range(runs)]
+        opts = np.array([r.opt for r in res])
+        rows.append({
+            **setting,
+            'opt_mean': np.nanmean(opts),
+            'opt_std': np.nanstd(opts),
+            'width_mean': np.mean([r.lim[1] - r.lim[0] for r in res]),
+            'trials_mean': np.mean([r.trials for r in res]),
+            })
+
+    return pd.DataFrame(rows)
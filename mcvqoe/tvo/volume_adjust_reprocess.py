@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+Reprocess saved TVO sessions.
+
+Recompute FSF scores and mouth-to-ear latency for the recordings of one or
+more TVO sessions and write the results to a reprocessed csv that
+mcvqoe.tvo.evaluate uses when use_reprocess is True.
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import functools
+import os
+import re
+
+import mcvqoe.base
+import scipy.signal
+
+from fractions import Fraction
+from mcvqoe.base.terminal_user import terminal_progress_update
+
+from .volume_adjust import clip_reference, measure, soundfile
+from .volume_adjust_archive import recording_archive
+
+# Prefix added to the session csv name for reprocessed data
+reprocess_prefix = 'R'
+
+# Pattern for received audio files written by measure.run
+_rx_pattern = re.compile(r'^Rx(?P<num>\d+)_(?P<clip>.+)\.(wav|flac)$')
+
+
+def session_csv(session_dir):
+    """
+    Return the path to the data csv of a session.
+
+    Parameters
+    ----------
+    session_dir : str
+        Session folder as created by measure.run.
+
+    Returns
+    -------
+    str
+        Path to the session csv file.
+    """
+    name = os.path.basename(os.path.normpath(session_dir))
+    return os.path.join(session_dir, name + '.csv')
+
+
+def reprocessed_csv(csv_path):
+    """
+    Return the path of the reprocessed csv for a session csv.
+
+    Parameters
+    ----------
+    csv_path : str
+        Path to the original session csv.
+
+    Returns
+    -------
+    str
+        Path to the reprocessed csv file.
+    """
+    dat_path, name = os.path.split(csv_path)
+    return os.path.join(dat_path, reprocess_prefix + name)
+
+
+def find_sessions(path):
+    """
+    Find TVO session folders in path.
+
+    Parameters
+    ----------
+    path : str
+        A session folder, a session csv or a folder that contains session
+        folders at any depth.
+
+    Returns
+    -------
+    list of str
+        Sorted list of session folders.
+    """
+    if os.path.isfile(path):
+        return [os.path.dirname(os.path.abspath(path))]
+
+    sessions = []
+    for root, dirs, _ in os.walk(path):
+        if 'wav' in dirs and os.path.exists(session_csv(root)):
+            sessions.append(root)
+            # Don't descend into the session
+            dirs.clear()
+
+    return sorted(sessions)
+
+
+def rx_files(wav_dir):
+    """
+    Get received audio from a session wav folder in trial order.
+
+    Recordings are taken from the recording archive if the session has one,
+    otherwise from wav files.
+
+    Parameters
+    ----------
+    wav_dir : str
+        Session wav folder.
+
+    Returns
+    -------
+    list of tuple
+        List of (trial number, clip name, source) tuples. The source can be
+        passed to read_recording.
+    """
+    if recording_archive.exists(wav_dir):
+        names = recording_archive(wav_dir).names()
+        sources = [(wav_dir, n) for n in names]
+    else:
+        names = os.listdir(wav_dir)
+        sources = [os.path.join(wav_dir, n) for n in names]
+
+    files = []
+    for name, src in zip(names, sources):
+        m = _rx_pattern.match(name)
+        if m:
+            files.append((int(m.group('num')), m.group('clip'), src))
+
+    return sorted(files)
+
+
+@functools.lru_cache(maxsize=None)
+def _open_archive(wav_dir):
+    """Open a recording archive. Cached per worker process."""
+    return recording_archive(wav_dir)
+
+
+def read_recording(src):
+    """
+    Read a recording.
+
+    Parameters
+    ----------
+    src : str or tuple
+        Path to a wav or FLAC file or a (folder, name) tuple for a recording
+        in a recording archive. If a compressed recording was not written, or
+        a wav file was compressed, the other format is read instead.
+
+    Returns
+    -------
+    fs : int
+        Sample rate of the recording.
+    data : numpy array
+        Float audio of the recording.
+    """
+    if isinstance(src, tuple):
+        return _open_archive(src[0]).read(src[1])
+
+    if not os.path.exists(src):
+        # Compression may not have happened, or may have replaced the file
+        base, ext = os.path.splitext(src)
+        alt = base + ('.wav' if ext == '.flac' else '.flac')
+        if os.path.exists(alt):
+            src = alt
+
+    if src.endswith('.flac'):
+        if soundfile is None:
+            raise RuntimeError('The soundfile package is required to read FLAC recordings')
+        data, fs = soundfile.read(src)
+        return fs, data
+
+    fs, data = mcvqoe.base.audio_read(src)
+    return fs, mcvqoe.base.audio_float(data)
+
+
+def _src_name(src):
+    """Return the file name of a recording source."""
+    if isinstance(src, tuple):
+        return src[1]
+    return os.path.basename(src)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_tx(tx_name, fs):
+    """Load a transmit clip, resampled to fs. Cached per worker process."""
+    fs_file, tx_dat = read_recording(tx_name)
+    if fs_file != fs:
+        rs_factor = Fraction(fs / fs_file)
+        tx_dat = scipy.signal.resample_poly(
+            tx_dat, rs_factor.numerator, rs_factor.denominator
+        )
+    return clip_reference(tx_dat, fs)
+
+
+def _score_trial(tx_name, rx_name, align=False):
+    """Compute FSF score and M2E latency for a single trial."""
+    fs, rx_dat = read_recording(rx_name)
+    tx_ref = _load_tx(tx_name, fs)
+
+    if align:
+        fsf_score, dly = tx_ref.score(rx_dat)
+    else:
+        fsf_score, dly = tx_ref.fsf(rx_dat)
+
+    return fsf_score, dly / fs
+
+
+def _read_session(csv_path):
+    """Return all rows, the data header and the data rows of a session csv."""
+    with open(csv_path, 'r', newline='') as f:
+        rows = list(csv.reader(f))
+
+    # First two rows are optimum, then data header and data
+    if len(rows) < 3:
+        raise ValueError(f'{csv_path} has no data header')
+
+    return rows, rows[2], rows[3:]
+
+
+def _session_jobs(session_dir, audio_path):
+    """
+    Return list of (tx_name, rx_name) pairs for a session.
+
+    The recordings are checked against the session csv so that problems are
+    found before any scoring is done.
+
+    Raises
+    ------
+    ValueError
+        If the recordings do not match the trials in the session csv or
+        transmit audio for a recording can not be found.
+    """
+    wav_dir = os.path.join(session_dir, 'wav')
+    if recording_archive.exists(wav_dir):
+        archived = set(recording_archive(wav_dir).names())
+    else:
+        archived = set()
+
+    csv_path = session_csv(session_dir)
+    _, header, data = _read_session(csv_path)
+    if 'Filename' not in header:
+        raise ValueError(f'{csv_path} has no Filename column')
+    name_idx = header.index('Filename')
+
+    rx = rx_files(wav_dir)
+    if len(data) != len(rx):
+        raise ValueError(f'{csv_path} has {len(data)} trials but {len(rx)} recordings were found')
+
+    jobs = []
+    for row, (_, clip, rx_name) in zip(data, rx):
+        # Make sure that the recording belongs to this row
+        csv_clip = os.path.basename(row[name_idx])
+        if clip != csv_clip:
+            raise ValueError(f'Recording {_src_name(rx_name)} does not match csv clip {csv_clip}')
+
+        tx_name = os.path.join(wav_dir, f'Tx_{clip}.wav')
+        if f'Tx_{clip}.wav' in archived:
+            tx_name = (wav_dir, f'Tx_{clip}.wav')
+        elif not os.path.exists(tx_name):
+            # Tx audio was not saved, fall back to clips in audio_path
+            tx_name = os.path.join(audio_path, clip + '.wav')
+        if not isinstance(tx_name, tuple) and not os.path.exists(tx_name):
+            raise ValueError(f'Could not find transmit audio for {_src_name(rx_name)}')
+        jobs.append((tx_name, rx_name))
+
+    return jobs
+
+
+def _write_session(csv_path, out_path, results):
+    """Write reprocessed csv with new FSF and M2E values."""
+    rows, header, data = _read_session(csv_path)
+
+    fsf_idx = header.index('FSF')
+    m2e_idx = header.index('m2e_latency')
+
+    for row, (fsf_score, m2e) in zip(data, results):
+        row[fsf_idx] = f'{fsf_score}'
+        row[m2e_idx] = f'{m2e}'
+
+    with open(out_path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerows(rows)
+
+
+def reprocess(paths, audio_path=None, workers=None, align=False,
+              progress_update=terminal_progress_update):
+    """
+    Reprocess TVO sessions in parallel.
+
+    All trials from all sessions are scored in a single process pool and a
+    reprocessed csv is written next to each session csv. Sessions whose
+    recordings do not match the session csv, or that are missing transmit
+    audio, are reported and skipped before scoring starts.
+
+    Parameters
+    ----------
+    paths : str or list of str
+        Session folders, session csv files or folders containing sessions.
+    audio_path : str, optional
+        Path to transmit clips, used when Tx audio was not saved with the
+        session. Defaults to the clips included with the package.
+    workers : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+    align : bool, optional
+        Trim recordings around the envelope delay before scoring, see
+        measure.align. Defaults to False.
+    progress_update : function, optional
+        Function to report progress. Defaults to terminal_progress_update.
+
+    Returns
+    -------
+    list of str
+        Paths to the reprocessed csv files of the sessions that were
+        reprocessed.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    if audio_path is None:
+        audio_path = measure.included_audio_path()
+
+    sessions = []
+    for p in paths:
+        sessions.extend(find_sessions(p))
+
+    if not sessions:
+        raise ValueError(f'No TVO sessions found in {paths}')
+
+    good_sessions = []
+    session_jobs = []
+    for session in sessions:
+        try:
+            jobs = _session_jobs(session, audio_path)
+        except (ValueError, OSError) as e:
+            progress_update('status', 0, 0, msg=f'Skipping {session}: {e}')
+            continue
+        good_sessions.append(session)
+        session_jobs.append(jobs)
+    sessions = good_sessions
+
+    tx_names = [tx for jobs in session_jobs for tx, _ in jobs]
+    rx_names = [rx for jobs in session_jobs for _, rx in jobs]
+    num_trials = len(rx_names)
+
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        res_iter = executor.map(functools.partial(_score_trial, align=align),
+                                tx_names, rx_names,
+                                chunksize=max(1, num_trials // 256))
+        for n, res in enumerate(res_iter):
+            progress_update('proc', num_trials=num_trials, current_trial=n)
+            results.append(res)
+
+    out_names = []
+    start = 0
+    for session, jobs in zip(sessions, session_jobs):
+        csv_path = session_csv(session)
+        out_path = reprocessed_csv(csv_path)
+        _write_session(csv_path, out_path, results[start:start+len(jobs)])
+        start += len(jobs)
+        out_names.append(out_path)
+        progress_update('status', 0, 0, msg=f'Reprocessed data written to {out_path}')
+
+    return out_names
+
+
+# Main definition
+def main():
+    """
+    Reprocess TVO sessions with command line arguments.
+
+    Returns
+    -------
+    None.
+
+    """
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('paths',
+                        type=str,
+                        nargs="+",
+                        action="extend",
+                        help=("Session folders, session csv files or folders "
+                              "containing sessions to reprocess."))
+    parser.add_argument('-a', '--audio-path',
+                        default=None,
+                        type=str,
+                        help=("Path to transmit clips, used when Tx audio was "
+                              "not saved with a session."))
+    parser.add_argument('-j', '--jobs',
+                        default=None,
+                        type=int,
+                        help="Number of worker processes to use.")
+    parser.add_argument('--align',
+                        default=False,
+                        action="store_true",
+                        help=("Trim recordings around the envelope delay "
+                              "before scoring."))
+
+    args = parser.parse_args()
+
+    reprocess(args.paths, audio_path=args.audio_path, workers=args.jobs,
+              align=args.align)
+
+
+if __name__ == "__main__":
+    main()
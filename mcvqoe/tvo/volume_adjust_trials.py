@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Trial record store for TVO.
+
+Results of every trial in a session are kept in a single structured numpy
+array so that per-step statistics are array slices and csv rows can be
+written in bulk.
+"""
+
+import numpy as np
+
+# Fields stored for each trial
+trial_dtype = np.dtype([
+    ('Volume', 'f8'),
+    ('Clip', 'i4'),
+    ('Step', 'i4'),
+    ('FSF', 'f8'),
+    ('m2e_latency', 'f8'),
+    ('Timestamp', 'datetime64[s]'),
+    ('Channels', 'O'),
+    ('Rx_Peak', 'f8'),
+    ('Clip_Ratio', 'f8'),
+    ('Rx_Level_dB', 'f8'),
+    ('Noise_Floor_dB', 'f8'),
+    ])
+
+
+class trial_store:
+    """
+    Preallocated store of trial results.
+
+    The store grows if more trials are added than it was allocated for.
+
+    Parameters
+    ----------
+    capacity : int, optional
+        Number of trials to allocate space for. Defaults to 0.
+
+    Attributes
+    ----------
+    count : int
+        Number of trials in the store.
+    """
+
+    def __init__(self, capacity=0):
+        self._data = np.zeros(max(int(capacity), 1), dtype=trial_dtype)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def records(self):
+        """Structured array of the trials in the store."""
+        return self._data[:self.count]
+
+    def add(self, volume, clip, fsf, m2e_latency, timestamp, channels, step=-1,
+            rx_peak=np.nan, clip_ratio=np.nan, rx_level=np.nan, noise_floor=np.nan):
+        """
+        Add a trial to the store.
+
+        Parameters
+        ----------
+        volume : float
+            Volume of the trial in dB.
+        clip : int
+            Index of the clip played.
+        fsf : float
+            FSF score of the trial.
+        m2e_latency : float
+            Mouth to ear latency of the trial in seconds.
+        timestamp : datetime.datetime
+            Time of the trial.
+        channels : str
+            Channel description of the recording.
+        step : int, optional
+            Optimizer step that the trial belongs to. Defaults to -1, no step.
+        rx_peak : float, optional
+            Largest sample magnitude of the recording.
+        clip_ratio : float, optional
+            Fraction of clipped samples in the recording.
+        rx_level : float, optional
+            RMS level of the recording in dB.
+        noise_floor : float, optional
+            Noise floor of the recording in dB.
+
+        Returns
+        -------
+        int
+            Index of the trial.
+        """
+        if self.count == len(self._data):
+            # Out of space, double the size
+            self._data = np.concatenate((self._data, np.zeros_like(self._data)))
+
+        self._data[self.count] = (volume, clip, step, fsf, m2e_latency,
+                                  np.datetime64(timestamp, 's'), channels,
+                                  rx_peak, clip_ratio, rx_level, noise_floor)
+        self.count += 1
+
+        return self.count - 1
+
+    def step_fsf(self, step):
+        """Return the FSF scores of all trials from an optimizer step."""
+        rec = self.records
+        return rec['FSF'][rec['Step'] == step]
+
+    def csv_rows(self, start, stop, fields, clip_names):
+        """
+        Format trials as csv data rows.
+
+        Parameters
+        ----------
+        start : int
+            Index of the first trial.
+        stop : int
+            Index after the last trial.
+        fields : list of str
+            csv fields in order, see measure.csv_header_fmt.
+        clip_names : list of str
+            Name of each clip without extension.
+
+        Returns
+        -------
+        str
+            csv rows, one line for each trial.
+        """
+        rec = self._data[start:stop]
+        names = [clip_names[c] for c in rec['Clip'].tolist()]
+
+        cols = {
+            'Timestamp': [t.strftime("%d-%b-%Y %H:%M:%S") for t in rec['Timestamp'].tolist()],
+            'Filename': names,
+            'Volume': [str(v) for v in rec['Volume'].tolist()],
+            'FSF': [str(v) for v in rec['FSF'].tolist()],
+            'm2e_latency': [str(v) for v in rec['m2e_latency'].tolist()],
+            'Channels': [str(c) for c in rec['Channels']],
+            'Rx_Peak': [str(v) for v in rec['Rx_Peak'].tolist()],
+            'Clip_Ratio': [str(v) for v in rec['Clip_Ratio'].tolist()],
+            'Rx_Level_dB': [str(v) for v in rec['Rx_Level_dB'].tolist()],
+            'Noise_Floor_dB': [str(v) for v in rec['Noise_Floor_dB'].tolist()],
+            # Compressed recording, named from the trial number
+            'Audio': [f'Rx{n}_{name}.flac' for n, name in enumerate(names, start=start + 1)],
+            }
+
+        return ''.join(','.join(row) + '\n' for row in zip(*(cols[f] for f in fields)))
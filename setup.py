@@ -25,9 +25,13 @@ setuptools.setup(
         'mcvqoe-base',
         'scipy',
     ],
+    extras_require={
+        'flac': ['soundfile'],
+    },
     entry_points={
         'console_scripts':[
             'tvo=mcvqoe.tvo.volume_adjust_hw_test:main',
+            'tvo-reprocess=mcvqoe.tvo.volume_adjust_reprocess:main',
         ],
     },
     python_requires='>=3.6',
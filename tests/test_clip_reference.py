@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Tests for FSF scoring with cached clip features."""
+
+import os
+
+import mcvqoe.base
+import numpy as np
+import pytest
+
+from mcvqoe.tvo.volume_adjust import clip_reference, measure
+
+
+@pytest.fixture(scope='module')
+def clip():
+    fs, audio = mcvqoe.base.audio_read(
+        os.path.join(measure.included_audio_path(), 'Vol_Set_F1.wav')
+        )
+    return fs, mcvqoe.base.audio_float(audio)
+
+
+def delayed(audio, delay, rng):
+    """Recording of audio at half level, delayed, with a little noise."""
+    rec = np.concatenate((np.zeros(delay), 0.5*audio, np.zeros(9600)))
+    return rec + rng.normal(0, 1e-4, len(rec))
+
+
+@pytest.mark.filterwarnings('ignore:Negative delay detected')
+def test_fsf_matches_base(clip):
+    fs, audio = clip
+    ref = clip_reference(audio, fs)
+    rec = delayed(audio, 4800, np.random.default_rng(0))
+
+    assert ref.fsf(rec) == mcvqoe.base.fsf(audio, rec)
+
+
+@pytest.mark.filterwarnings('ignore:Negative delay detected')
+@pytest.mark.parametrize('delay', [4800, 14400])
+def test_trimmed_delay_matches_full(clip, delay):
+    fs, audio = clip
+    ref = clip_reference(audio, fs)
+    rec = delayed(audio, delay, np.random.default_rng(1))
+
+    full_fsf, full_dly = ref.fsf(rec)
+    fsf_score, dly = ref.score(rec)
+
+    # fsf delays are negative for a lagging recording
+    assert full_dly == -delay
+    assert dly == full_dly
+    assert fsf_score == pytest.approx(full_fsf, rel=0.05)
+
+
+def score_obj(ref, **params):
+    """Measure object that scores with ref as clip 0."""
+    test_obj = measure(**params)
+    test_obj.clip_refs = [ref]
+    test_obj.trial_delays = []
+    return test_obj
+
+
+@pytest.mark.filterwarnings('ignore:Negative delay detected')
+def test_m2e_window_matches_full_search(clip):
+    fs, audio = clip
+    ref = clip_reference(audio, fs)
+    rng = np.random.default_rng(2)
+
+    windowed = score_obj(ref, m2e_window=0.05)
+    full = score_obj(ref)
+
+    calls = []
+    score_at = ref.score_at
+    def spy(*args, **kwargs):
+        calls.append(args[1])
+        return score_at(*args, **kwargs)
+    ref.score_at = spy
+
+    for delay in (14400, 14450, 14350, 14400, 14420):
+        rec = delayed(audio, delay, rng)
+        assert windowed.score(0, rec) == pytest.approx(full.score(0, rec), rel=0.05)
+
+    # The narrowed search is used once there are enough previous trials
+    assert len(calls) == 2
+    np.testing.assert_array_equal(windowed.trial_delays, full.trial_delays)
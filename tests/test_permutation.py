@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""Tests for the approximate permutation test used by the TVO optimizer."""
+
+import numpy as np
+
+from mcvqoe.tvo.volume_adjust import approx_permutation_test
+
+
+def test_identical_distributions_reject_at_alpha():
+    rng = np.random.default_rng(0)
+    alpha = 0.05
+    runs = 400
+
+    rejects = sum(
+        approx_permutation_test(rng.normal(0, 1, 20), rng.normal(0, 1, 20), rng,
+                                R=1000, alpha=alpha)
+        for _ in range(runs)
+        )
+
+    # About 4.5 standard deviations of the binomial rejection count
+    assert abs(rejects/runs - alpha) < 0.05
+
+
+def test_different_means_rejected():
+    rng = np.random.default_rng(1)
+
+    assert approx_permutation_test(rng.normal(0, 1, 20), rng.normal(2, 1, 20), rng)
+
+
+def test_same_generator_state_same_result():
+    x = np.linspace(0, 1, 15)
+    y = x + 0.2
+
+    first = approx_permutation_test(x, y, np.random.default_rng(7), R=500)
+    second = approx_permutation_test(x, y, np.random.default_rng(7), R=500)
+
+    assert first == second
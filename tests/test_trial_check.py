@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""Tests for bad trial detection."""
+
+import numpy as np
+
+from mcvqoe.tvo.volume_adjust import measure
+
+
+def check_obj():
+    test_obj = measure()
+    test_obj.trial_delays = [0]
+    return test_obj
+
+
+def test_quiet_trial_is_good():
+    # Level of a trial at -40 dB with the simulated channel
+    assert check_obj().trial_check(1.0, 0.0, -67.5, -100.0, np.array([])) is None
+
+
+def test_noise_only_trial_is_bad():
+    reason = check_obj().trial_check(1.0, 0.0, -58.0, -61.0, np.array([]))
+    assert reason == 'Low Rx level'
+
+
+def test_silent_trial_is_bad():
+    reason = check_obj().trial_check(1.0, 0.0, -200.0, -200.0, np.array([]))
+    assert reason == 'Low Rx level'
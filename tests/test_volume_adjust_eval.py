@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""Tests for live evaluation of a running session."""
+
+import pytest
+
+from mcvqoe.tvo.volume_adjust_eval import evaluate_live
+
+header = 'Timestamp,Filename,Volume,FSF,m2e_latency,Channels\n'
+
+
+def rows(volume, fsf, clips=('F1', 'M3')):
+    return ''.join(f'19-Oct-2026 00:00:00,{c},{volume},{fsf},0.0,1rx\n' for c in clips)
+
+
+def test_refresh_extends_traces(tmp_path):
+    temp = tmp_path / 'test_TEMP.csv'
+    temp.write_text(header + rows(-20, 0.5))
+
+    live = evaluate_live(str(temp))
+    fig = live.refresh()
+    traces = {t.name: t for t in fig.data}
+    assert len(traces['F1'].x) == 1
+    assert list(traces['Average FSF'].x) == [-20]
+
+    with open(temp, 'a') as f:
+        f.write(rows(-10, 0.7) + rows(-10, 0.9, clips=('F1',)))
+
+    assert live.refresh(fig) is fig
+    traces = {t.name: t for t in fig.data}
+    assert list(traces['F1'].x) == [-20, -10, -10]
+    assert list(traces['M3'].x) == [-20, -10]
+    assert list(traces['Average FSF'].y) == pytest.approx([0.5, (0.7 + 0.7 + 0.9)/3])
+    # Each trace is only drawn once
+    assert len(fig.data) == len(traces)
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""Tests for the session profiler phase table."""
+
+from mcvqoe.tvo.volume_adjust_profiler import session_profiler
+
+
+def test_only_compression_drain_is_compression_wait():
+    prof = session_profiler(cprofile=False)
+    prof.start()
+    prof.add('drain_compress', 1.0)
+    prof.add('shutdown', 0.5)
+    prof.stop()
+
+    assert prof.phases['compression wait'] == [1, 1.0]
+    assert prof.phases['other'] == [1, 0.5]
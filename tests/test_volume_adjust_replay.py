@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""Tests for replaying recorded data through the TVO optimizer."""
+
+import numpy as np
+import pandas as pd
+
+from mcvqoe.tvo.volume_adjust_replay import replay, trial_source
+
+
+def synthetic_data(seed=0, reps=40):
+    """Recorded trials with FSF rising with volume and peaking near -10 dB."""
+    rng = np.random.default_rng(seed)
+    volumes = np.repeat(np.arange(-40.0, 1.0, 2.0), reps)
+    fsf = 0.9 - 0.0008*(volumes + 10)**2 + rng.normal(0, 0.03, len(volumes))
+    return pd.DataFrame({'Volume': volumes, 'FSF': fsf})
+
+
+def assert_same_result(a, b):
+    np.testing.assert_equal(a.opt, b.opt)
+    np.testing.assert_equal(a.lim, b.lim)
+    np.testing.assert_equal(a.volumes, b.volumes)
+    assert a.trials == b.trials
+    assert a.done_step == b.done_step
+
+
+def test_replay_same_seed_same_result():
+    data = synthetic_data()
+
+    first = replay(data, rng=np.random.default_rng(1234))
+    second = replay(data, rng=np.random.default_rng(1234))
+
+    assert_same_result(first, second)
+    assert len(first.volumes) > 0
+    assert first.trials > 0
+
+
+def test_replay_trial_source_same_seed_same_result():
+    data = synthetic_data()
+
+    first = replay(trial_source(data, rng=np.random.default_rng(99)))
+    second = replay(trial_source(data, rng=np.random.default_rng(99)))
+
+    assert_same_result(first, second)
+
+
+def test_trial_source_draws_recorded_scores():
+    data = synthetic_data()
+    source = trial_source(data, rng=np.random.default_rng(5))
+
+    # Recorded volume, only trials at that volume are drawn
+    fsf = source.draw(-10.0, 100)
+    assert np.all(np.isin(fsf, data['FSF'][data['Volume'] == -10.0]))
+
+    # Between recorded volumes, trials come from the bracketing volumes
+    fsf = source.draw(-9.0, 100)
+    assert np.all(np.isin(fsf, data['FSF'][data['Volume'].isin([-10.0, -8.0])]))
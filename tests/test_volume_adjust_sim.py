@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""End to end tests of measure.run with the simulated channel."""
+
+import os
+
+import numpy as np
+import pytest
+
+from mcvqoe.tvo.volume_adjust_hw_test import job_measure
+from mcvqoe.tvo.volume_adjust_reprocess import session_csv
+
+simulation = pytest.importorskip('mcvqoe.simulation')
+
+
+def _no_progress(*args, **kwargs):
+    return True
+
+
+def sim_measure(outdir, **params):
+    """Measure object on a QoEsim channel without PTT pauses."""
+    job = {'ptt_gap': 0, 'ptt_wait': 0, 'seed': 3, 'progress_update': _no_progress}
+    job.update(params)
+    test_obj = job_measure(job, outdir=str(outdir))
+
+    sim_obj = simulation.QoEsim()
+    test_obj.ri = sim_obj
+    test_obj.audio_interface = sim_obj
+    test_obj.param_check()
+
+    return test_obj
+
+
+def test_coarse_run(tmp_path):
+    # Enough steps to top up the coarse grid and group the topped up steps
+    test_obj = sim_measure(tmp_path, ptt_rep=4, coarse_rep=1, smax=16)
+    test_obj.run()
+
+    assert len(test_obj.opt_save) == 1
+    assert not np.isnan(test_obj.opt_save[0])
+    # Some coarse volumes were topped up to ptt_rep trials
+    assert len(test_obj.trials) > test_obj.smax
+    assert os.path.exists(session_csv(test_obj.data_dirs[0]))
+
+
+def test_precharacterize_stops_at_compression(tmp_path):
+    test_obj = sim_measure(tmp_path, lim=[-40, 20])
+    test_obj.load_audio()
+    test_obj.wav_data_dir = str(tmp_path)
+    test_obj.data_filename = str(tmp_path / 'sweep.csv')
+
+    lim = test_obj.precharacterize_sweep()
+
+    cal = np.genfromtxt(tmp_path / 'sweep_CAL.csv', delimiter=',', names=True)
+    volume = cal['Volume']
+    gain = np.diff(cal['Rx_Level_dB']) / np.diff(volume)
+    compressed = np.concatenate(([False], gain < 0.5)) | (cal['Peak'] > 0.99)
+    # Channel compresses or clips before the top of the sweep
+    assert np.any(compressed[:-1])
+
+    # Upper limit is the first compressed level, one step above the last
+    # linear level
+    assert lim[1] == volume[np.argmax(compressed)]
+    assert lim[0] == -40